@@ -0,0 +1,124 @@
+import argparse
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+from pathlib import Path
+from tqdm import tqdm
+
+parser = argparse.ArgumentParser(description='Scan the dataset into a manifest and generate the vocabulary and the splits from it. '
+                                             'Re-runs only read new or changed files.')
+
+parser.add_argument("--data_path", type=str,
+                        default=Path("data", "web", "all_data"), help="Datapath")
+parser.add_argument("--output_path", type=str,
+                        default=None, help="Folder of the manifest, vocab and split files, defaults to the parent of the datapath")
+parser.add_argument("--workers", type=int,
+                        default=os.cpu_count(), help="Number of processes reading the changed files")
+parser.add_argument("--train_percent", type=float, default=0.6)
+parser.add_argument("--validation_percent", type=float, default=0.2)
+parser.add_argument("--split_salt", type=str,
+                        default="", help="Changes the hashed split assignment")
+
+MANIFEST_VERSION = 1
+
+
+def parse_gui_tokens(raw_data):
+    # Same tokenization as Pix2CodeDataset.parse_gui_token_file
+    tokens = raw_data.replace('\n', ' ').replace(', ', ' , ').split(' ')
+    tokens.remove('')
+    return tokens
+
+
+def scan_file(args):
+    """Hashes a file and, for .gui files, counts its tokens and lists the distinct ones in order."""
+    path, mtime_ns, size = args
+    with open(path, "rb") as reader:
+        content = reader.read()
+
+    record = {"mtime_ns": mtime_ns, "size": size, "hash": hashlib.sha1(content).hexdigest()}
+    if path.endswith(".gui"):
+        tokens = parse_gui_tokens(content.decode())
+        record["token_count"] = len(tokens)
+        record["tokens"] = list(dict.fromkeys(tokens))
+
+    return os.path.basename(path), record
+
+
+def split_of(stem, salt, train_percent, validation_percent):
+    # Stable for a given example, so adding files never moves the existing ones to another split
+    position = int(hashlib.sha1((salt + stem).encode()).hexdigest()[:8], 16) / 16 ** 8
+    if position < train_percent:
+        return "train"
+    if position < train_percent + validation_percent:
+        return "validation"
+    return "test"
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    data_path = Path(args.data_path)
+    output_path = Path(args.output_path) if args.output_path else data_path.parent
+    manifest_path = output_path / "manifest.json"
+
+    files = dict()
+    if manifest_path.exists():
+        with open(manifest_path, "r") as reader:
+            manifest = json.load(reader)
+        if manifest.get("version") == MANIFEST_VERSION:
+            files = manifest["files"]
+
+    # A single directory scan, the stat results come with the directory entries
+    current = dict()
+    to_scan = []
+    with os.scandir(data_path) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith((".gui", ".png")):
+                continue
+            stat = entry.stat()
+            current[entry.name] = (stat.st_mtime_ns, stat.st_size)
+            record = files.get(entry.name)
+            if not record or record["mtime_ns"] != stat.st_mtime_ns or record["size"] != stat.st_size:
+                to_scan.append((entry.path, stat.st_mtime_ns, stat.st_size))
+
+    removed = [name for name in files if name not in current]
+    for name in removed:
+        del files[name]
+    print(f'Found {len(current)} files, {len(to_scan)} new or changed, {len(removed)} removed')
+
+    if to_scan:
+        with Pool(processes=args.workers) as pool:
+            for name, record in tqdm(pool.imap_unordered(scan_file, to_scan, chunksize=64), total=len(to_scan)):
+                files[name] = record
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, "w") as writer:
+        json.dump({"version": MANIFEST_VERSION, "files": files}, writer)
+
+    # Examples need exactly one .gui and one .png file
+    stems = sorted({Path(name).stem for name in files})
+    valid_pairs = [stem for stem in stems if stem + ".gui" in files and stem + ".png" in files]
+    for stem in stems:
+        if stem not in valid_pairs:
+            print(f'File {stem} is not a valid pair')
+    print(f'Found a total of {len(valid_pairs)} valid examples')
+
+    # dict used as ordered set, filled in filename order so the vocab is deterministic
+    all_tokens = dict()
+    for stem in stems:
+        if stem + ".gui" in files:
+            all_tokens.update(dict.fromkeys(files[stem + ".gui"]["tokens"]))
+
+    print(f'Writing vocab with {len(all_tokens)} tokens')
+    with open(output_path / "vocab.txt", "w") as writer:
+        writer.write(" ".join(all_tokens))
+
+    dataset_splits = {"train": [], "validation": [], "test": []}
+    for stem in valid_pairs:
+        dataset_splits[split_of(stem, args.split_salt, args.train_percent, args.validation_percent)].append(stem)
+
+    for key, value in dataset_splits.items():
+        print(f'{key}: {len(value)} examples')
+        with open(output_path / f'{key}_dataset.txt', "w") as writer:
+            for example in value:
+                writer.write(example + "\n")
@@ -1,6 +1,10 @@
+import json
 from pathlib import Path
 from PIL import Image
+import numpy as np
 import torch
+from torchvision import transforms
+from utils import RESNET_MEAN, RESNET_STD
 
 class Pix2CodeDataset():
 
@@ -20,22 +24,29 @@ class Pix2CodeDataset():
 
     def __getitem__(self, idx):
         img_path = Path(self.data_path, self.filenames[idx] + ".png")
-        tokens_path = Path(self.data_path, self.filenames[idx] + ".gui")
 
         image = Image.open(img_path).convert('RGB')
         if self.transform:
             image = self.transform(image)
 
+        return image, self.get_token_ids(idx)
+
+    def get_token_ids(self, idx):
+        tokens_path = Path(self.data_path, self.filenames[idx] + ".gui")
+
         tokens = self.parse_gui_token_file(tokens_path)
         tokens.insert(0, self.vocab.get_start_token())
         tokens.append(self.vocab.get_end_token())
 
-        token_ids = [self.vocab.get_id_by_token(token) for token in tokens]
+        token_ids = torch.from_numpy(self.vocab.get_ids_by_tokens(tokens))
 
-        token_ids = torch.Tensor(token_ids)
+        return token_ids
 
-        return image, token_ids
 
+    def get_token_lengths(self):
+        # Length of every token sequence including the START and END tokens
+        return [len(self.parse_gui_token_file(Path(self.data_path, filename + ".gui"))) + 2
+                for filename in self.filenames]
 
     def parse_gui_token_file(self, filepath):
         suffix = filepath.suffix
@@ -49,3 +60,67 @@ class Pix2CodeDataset():
             tokens.remove('')
 
         return tokens
+
+
+class PackedPix2CodeDataset():
+    """Reads a split written by pack_dataset.py through memory maps.
+
+    Images are stored resized as uint8 (n_images, 3, img_crop_size, img_crop_size) and the
+    token ids of all samples are concatenated in one flat array indexed by offsets.
+    """
+
+    def __init__(self, packed_path, split, vocab):
+        assert split in ["train", "validation", "test"]
+        self.packed_path = Path(packed_path)
+        self.split = split
+        self.vocab = vocab
+
+        with open(self.packed_path / f'{split}_meta.json', "r") as reader:
+            meta = json.load(reader)
+
+        assert meta["vocab"] == [vocab.get_token_by_id(id) for id in range(len(vocab))], \
+            "The packed dataset was built with a different vocab"
+
+        self.data_path = meta["data_path"]
+        self.filenames = meta["filenames"]
+        self.img_crop_size = meta["img_crop_size"]
+
+        self._images = None
+        self._token_ids = None
+        self._offsets = None
+
+    def __getstate__(self):
+        # Memory maps are reopened lazily in every DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state.update(_images=None, _token_ids=None, _offsets=None)
+        return state
+
+    def _open(self):
+        # Copy-on-write maps give writable arrays, so torch.from_numpy does not need to copy
+        self._images = np.load(self.packed_path / f'{self.split}_images.npy', mmap_mode="c")
+        self._token_ids = np.load(self.packed_path / f'{self.split}_token_ids.npy', mmap_mode="c")
+        self._offsets = np.load(self.packed_path / f'{self.split}_offsets.npy')
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, idx):
+        if self._images is None:
+            self._open()
+
+        image = torch.from_numpy(self._images[idx]).float().div_(255)
+        image = transforms.functional.normalize(image, RESNET_MEAN, RESNET_STD, inplace=True)
+
+        return image, self.get_token_ids(idx)
+
+    def get_token_ids(self, idx):
+        if self._images is None:
+            self._open()
+
+        return torch.from_numpy(self._token_ids[self._offsets[idx]:self._offsets[idx + 1]])
+
+    def get_token_lengths(self):
+        if self._images is None:
+            self._open()
+
+        return np.diff(self._offsets).tolist()
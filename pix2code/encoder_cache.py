@@ -0,0 +1,84 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+import torch.nn.functional as F
+
+
+def perceptual_hash(image, hash_size=32, step=0.25):
+    """Hash of a coarse, quantized thumbnail of a preprocessed (3, H, W) image tensor.
+
+    Every channel is pooled to hash_size x hash_size cells and rounded to multiples of step, in
+    normalized units, so re-encoding noise maps to the same key while layout or color changes
+    do not. Larger hash sizes and smaller steps tell more similar screenshots apart.
+    """
+    cells = F.adaptive_avg_pool2d(image.float().unsqueeze(0), hash_size)
+    quantized = torch.round(cells / step).clamp(-128, 127).to(torch.int8)
+    return hashlib.sha1(quantized.cpu().numpy().tobytes()).hexdigest()
+
+
+class EncoderCache():
+    """LRU cache in front of the Encoder, keyed by a perceptual hash of the preprocessed image.
+
+    It stores the encoder features and, with cache_outputs, the decoded tokens as well, so a hit
+    skips the resnet pass or the whole inference. Encoder features do not depend on the rest of
+    the batch in eval mode, so they can be reused across batches.
+    """
+
+    def __init__(self, max_entries=10000, hash_size=32, cache_outputs=False):
+        self.max_entries = max_entries
+        self.hash_size = hash_size
+        self.cache_outputs = cache_outputs
+
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, image):
+        return perceptual_hash(image, self.hash_size)
+
+    def _get(self, key, field):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or field not in entry:
+                return None
+            self.entries.move_to_end(key)
+            return entry[field]
+
+    def _put(self, key, field, value):
+        with self.lock:
+            self.entries.setdefault(key, dict())[field] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_output(self, key):
+        if not self.cache_outputs:
+            return None
+        output = self._get(key, "output")
+        if output is not None:
+            self.hits += 1
+        return output
+
+    def put_output(self, key, output):
+        if self.cache_outputs:
+            self._put(key, "output", output)
+
+    def encode(self, encoder, images, keys, device):
+        """Returns the features of a list of images, running the encoder only on the cache misses."""
+        features = [self._get(key, "features") for key in keys]
+        misses = [i for i, feature in enumerate(features) if feature is None]
+        self.hits += len(keys) - len(misses)
+        self.misses += len(misses)
+
+        if misses:
+            computed = encoder(torch.stack([images[i] for i in misses]).to(device))
+            for i, feature in zip(misses, computed):
+                features[i] = feature.detach().cpu()
+                self._put(keys[i], "features", features[i])
+
+        return torch.stack(features).to(device)
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
@@ -4,11 +4,14 @@ from vocab import Vocab
 import torch
 from torch.utils.data import DataLoader
 from torchvision import transforms
-from dataset import Pix2CodeDataset
-from utils import collate_fn, save_model, ids_to_tokens, generate_visualization_object, resnet_img_transformation
+from dataset import Pix2CodeDataset, PackedPix2CodeDataset
+from utils import PaddedBatchCollator, save_model, ids_to_tokens, generate_visualization_object, resnet_img_transformation
 from models import Encoder, Decoder
+from samplers import BucketBatchSampler
+from quantization import quantize_dynamic, quantize_static_trunk
 from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
 import math
+import time
 from tqdm import tqdm
 
 parser = argparse.ArgumentParser(description='Evaluate the model')
@@ -17,6 +20,8 @@ parser.add_argument("--model_file_path", type=str,
                     help="Path to the trained model file", required=True)
 parser.add_argument("--data_path", type=str,
                     default=Path("data", "web", "all_data"), help="Datapath")
+parser.add_argument("--packed_path", type=str, default=None,
+                    help="Read the split from the memory-mapped arrays written by pack_dataset.py")
 parser.add_argument("--cuda", action='store_true',
                     default=True, help="Use cuda or not")
 parser.add_argument("--img_crop_size", type=int, default=224)
@@ -24,6 +29,21 @@ parser.add_argument("--split", type=str, default="validation")
 parser.add_argument("--viz", action='store_true',
                     default=False,)
 parser.add_argument("--batch_size", type=int, default=4)
+parser.add_argument("--bucket_by_length", action='store_true', default=False,
+                    help="Batch together programs of similar token length")
+parser.add_argument("--max_tokens", type=int, default=None,
+                    help="Token budget per batch when bucketing by length, batch_size still caps the samples")
+parser.add_argument("--max_sentence_length", type=int, default=None,
+                    help="Maximum number of decoding steps, defaults to the longest training sequence stored in the model file")
+parser.add_argument("--beam_size", type=int, default=1,
+                    help="Beam width, 1 uses greedy decoding")
+parser.add_argument("--length_penalty", type=float, default=1.0,
+                    help="Length normalization exponent used to pick the best beam")
+parser.add_argument("--quantize", type=str, default="none", choices=["none", "dynamic", "static"],
+                    help="Also evaluate an int8 quantized copy on CPU and report the BLEU delta. dynamic quantizes "
+                         "the LSTM and linear layers, static additionally quantizes the resnet trunk")
+parser.add_argument("--calibration_batches", type=int, default=10,
+                    help="Number of batches used to calibrate the static quantization")
 parser.add_argument("--seed", type=int, default=2020,
                     help="The random seed for reproducing ")
 
@@ -35,7 +55,6 @@ torch.cuda.manual_seed(args.seed)
 
 # Setup GPU
 use_cuda = True if args.cuda and torch.cuda.is_available() else False
-assert use_cuda  # Trust me, you don't want to train this model on a cpu.
 device = torch.device("cuda" if use_cuda else "cpu")
 
 # Loading the model
@@ -44,11 +63,12 @@ hidden_size = 512
 num_layers = 1
 
 assert Path(args.model_file_path).exists()
-loaded_model = torch.load(args.model_file_path)
+loaded_model = torch.load(args.model_file_path, map_location=device)
 
 vocab = loaded_model["vocab"]
+max_sentence_length = args.max_sentence_length or loaded_model.get("max_sentence_length") or 100
 
-encoder = Encoder(embed_size)
+encoder = Encoder(embed_size, pretrained=False)
 decoder = Decoder(embed_size, hidden_size, len(vocab), num_layers)
 
 encoder.load_state_dict(loaded_model["encoder_model_state_dict"])
@@ -60,40 +80,90 @@ decoder = decoder.to(device)
 transform_imgs = resnet_img_transformation(args.img_crop_size)
 
 # Creating the data loader
+if args.packed_path:
+    dataset = PackedPix2CodeDataset(args.packed_path, args.split, vocab)
+    assert dataset.img_crop_size == args.img_crop_size, "The dataset was packed with another crop size"
+else:
+    dataset = Pix2CodeDataset(args.data_path, args.split,
+                              vocab, transform=transform_imgs)
+
+if args.bucket_by_length:
+    batch_sampler = BucketBatchSampler(dataset.get_token_lengths(), batch_size=args.batch_size,
+                                       max_tokens=args.max_tokens, shuffle=False)
+else:
+    batch_sampler = None
+
 data_loader = DataLoader(
-    Pix2CodeDataset(args.data_path, args.split,
-                    vocab, transform=transform_imgs),
-    batch_size=args.batch_size,
-    collate_fn=collate_fn,
+    dataset,
+    batch_size=1 if batch_sampler else args.batch_size,
+    batch_sampler=batch_sampler,
+    collate_fn=PaddedBatchCollator(vocab, sort_by_length=False),
     pin_memory=True if use_cuda else False,
     num_workers=4,
-    drop_last=True)
+    drop_last=False)
 
 # Evaluate the model
 encoder.eval()
 decoder.eval()
 
-predictions = []
-targets = []
-for i, (image, caption) in enumerate(tqdm(data_loader.dataset)):
-    image = image.to(device)
-    caption = caption.to(device)
+end_token_id = vocab.get_id_by_token(vocab.get_end_token())
+
+
+def predict(encoder, decoder, device):
+    predictions = []
+    targets = []
+    with torch.no_grad():
+        for i, (images, captions, lengths) in enumerate(tqdm(data_loader)):
+            images = images.to(device)
+
+            features = encoder(images)
 
-    features = encoder(image.unsqueeze(0))
+            if args.beam_size > 1:
+                sample_ids = decoder.beam_search(features, beam_size=args.beam_size,
+                                                 longest_sentence_length=max_sentence_length,
+                                                 end_token_id=end_token_id,
+                                                 length_penalty=args.length_penalty)
+            else:
+                sample_ids = decoder.sample(features, longest_sentence_length=max_sentence_length,
+                                            end_token_id=end_token_id)
+            sample_ids = sample_ids.cpu().numpy()
 
-    sample_ids = decoder.sample(features)
-    sample_ids = sample_ids.cpu().data.numpy()
+            predictions.extend(ids_to_tokens(vocab, sample_ids))
+            targets.extend(ids_to_tokens(vocab, captions.numpy()))
 
-    predictions.append(sample_ids)
-    targets.append(caption.cpu().numpy())
+    if batch_sampler:
+        # Restore the dataset order, which the visualization relies on
+        order = [idx for batch in batch_sampler for idx in batch]
+        predictions = [predictions[i] for i in sorted(range(len(order)), key=order.__getitem__)]
+        targets = [targets[i] for i in sorted(range(len(order)), key=order.__getitem__)]
 
-predictions = [ids_to_tokens(vocab, prediction) for prediction in predictions]
-targets = [ids_to_tokens(vocab, target) for target in targets]
+    return predictions, targets
+
+
+start = time.time()
+predictions, targets = predict(encoder, decoder, device)
+elapsed = time.time() - start
 
 bleu = corpus_bleu([[target] for target in targets], predictions,
                    smoothing_function=SmoothingFunction().method4)
 print("BLEU score: {}".format(bleu))
 
+if args.quantize != "none":
+    # Quantized kernels only run on CPU
+    quantized_encoder, quantized_decoder = quantize_dynamic(encoder, decoder)
+    if args.quantize == "static":
+        calibration_images = [images for i, (images, _, _) in zip(range(args.calibration_batches), data_loader)]
+        quantized_encoder = quantize_static_trunk(quantized_encoder, calibration_images)
+
+    start = time.time()
+    quantized_predictions, _ = predict(quantized_encoder, quantized_decoder, torch.device("cpu"))
+    quantized_elapsed = time.time() - start
+
+    quantized_bleu = corpus_bleu([[target] for target in targets], quantized_predictions,
+                                 smoothing_function=SmoothingFunction().method4)
+    print(f"Quantized ({args.quantize}) BLEU score: {quantized_bleu} | Delta: {quantized_bleu - bleu:+.4f}")
+    print(f"Inference time: {elapsed:.2f}s on {device} | Quantized: {quantized_elapsed:.2f}s on cpu")
+
 if args.viz:
     generate_visualization_object(data_loader.dataset, predictions, targets)
     print("generated visualisation object")
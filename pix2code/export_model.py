@@ -0,0 +1,81 @@
+import argparse
+import inspect
+import json
+from pathlib import Path
+import torch
+from models import Encoder, Decoder, GreedyCaptioner, DecoderStep
+
+parser = argparse.ArgumentParser(description='Export a trained model for the inference runtime')
+
+parser.add_argument("--model_file_path", type=str,
+                    help="Path to the trained model file", required=True)
+parser.add_argument("--output_path", type=str, required=True,
+                    help="TorchScript file to write, or folder of the ONNX graphs")
+parser.add_argument("--format", type=str, default="torchscript", choices=["torchscript", "onnx"])
+parser.add_argument("--img_crop_size", type=int, default=224)
+parser.add_argument("--max_sentence_length", type=int, default=None,
+                    help="Maximum number of decoding steps, defaults to the longest training sequence stored in the model file")
+
+args = parser.parse_args()
+
+# Loading the model
+embed_size = 256
+hidden_size = 512
+num_layers = 1
+
+assert Path(args.model_file_path).exists()
+loaded_model = torch.load(args.model_file_path, map_location="cpu")
+
+vocab = loaded_model["vocab"]
+max_sentence_length = args.max_sentence_length or loaded_model.get("max_sentence_length") or 100
+end_token_id = vocab.get_id_by_token(vocab.get_end_token())
+
+encoder = Encoder(embed_size, pretrained=False)
+decoder = Decoder(embed_size, hidden_size, len(vocab), num_layers)
+
+encoder.load_state_dict(loaded_model["encoder_model_state_dict"])
+decoder.load_state_dict(loaded_model["decoder_model_state_dict"])
+
+encoder.eval()
+decoder.eval()
+
+# Everything the runtime needs besides the graph, so it does not unpickle the vocab
+meta = {"vocab": [vocab.get_token_by_id(id) for id in range(len(vocab))],
+        "img_crop_size": args.img_crop_size,
+        "max_sentence_length": max_sentence_length,
+        "end_token_id": end_token_id,
+        "num_layers": num_layers,
+        "hidden_size": hidden_size}
+
+if args.format == "torchscript":
+    scripted = torch.jit.script(GreedyCaptioner(encoder, decoder, max_sentence_length, end_token_id))
+    torch.jit.save(scripted, args.output_path, _extra_files={"meta.json": json.dumps(meta)})
+
+else:
+    # Loops with early exit do not map well to ONNX, so the encoder and a single decoding
+    # step are exported and the runtime runs the greedy loop
+    output_path = Path(args.output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+
+    # Newer torch versions default to the dynamo exporter, which does not keep the batch axis dynamic here
+    export_kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+
+    images = torch.zeros(1, 3, args.img_crop_size, args.img_crop_size)
+    torch.onnx.export(encoder, (images,), str(output_path / "encoder.onnx"),
+                      input_names=["images"], output_names=["features"],
+                      dynamic_axes={"images": {0: "batch"}, "features": {0: "batch"}},
+                      opset_version=11, **export_kwargs)
+
+    inputs = torch.zeros(1, 1, embed_size)
+    h = torch.zeros(num_layers, 1, hidden_size)
+    torch.onnx.export(DecoderStep(decoder), (inputs, h, h), str(output_path / "decoder_step.onnx"),
+                      input_names=["inputs", "h", "c"], output_names=["predicted", "next_inputs", "next_h", "next_c"],
+                      dynamic_axes={"inputs": {0: "batch"}, "h": {1: "batch"}, "c": {1: "batch"},
+                                    "predicted": {0: "batch"}, "next_inputs": {0: "batch"},
+                                    "next_h": {1: "batch"}, "next_c": {1: "batch"}},
+                      opset_version=11, **export_kwargs)
+
+    with open(output_path / "meta.json", "w") as writer:
+        json.dump(meta, writer)
+
+print(f"Exported {args.model_file_path} to {args.output_path}")
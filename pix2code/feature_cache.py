@@ -0,0 +1,119 @@
+import hashlib
+import json
+from pathlib import Path
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+# Size of the pooled features of the resnet152 trunk
+FEATURE_SIZE = 2048
+
+
+class FeatureCache():
+    """Memory-mapped on-disk cache of the frozen resnet trunk features.
+
+    Features are stored as a float32 (n_images, 2048) .npy file next to a json index
+    mapping each filename to its row. One cache file is kept per data folder and crop size,
+    since the rows are keyed by bare filename and splits reuse the same names.
+    """
+
+    def __init__(self, cache_dir, data_path, img_crop_size):
+        self.cache_dir = Path(cache_dir)
+        data_hash = hashlib.sha1(str(Path(data_path).resolve()).encode()).hexdigest()[:12]
+        name = f"resnet152-features-{data_hash}-{img_crop_size}"
+        self.features_path = self.cache_dir / f"{name}.npy"
+        self.index_path = self.cache_dir / f"{name}.json"
+
+        self.index = dict()
+        if self.index_path.exists() and self.features_path.exists():
+            with open(self.index_path, "r") as reader:
+                self.index = json.load(reader)
+
+        self._features = None
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # The memory map is reopened lazily in every DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state["_features"] = None
+        return state
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = np.load(self.features_path, mmap_mode="r")
+        return self._features
+
+    def get(self, filename):
+        return torch.from_numpy(np.array(self.features[self.index[filename]]))
+
+    def build(self, encoder, dataset, device, batch_size=4, num_workers=0):
+        """Runs the resnet trunk once over every image of the dataset that is not cached yet."""
+        missing = [idx for idx, filename in enumerate(dataset.filenames) if filename not in self.index]
+        if not missing:
+            return
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        n_cached = len(self.index)
+        tmp_features_path = self.features_path.with_suffix(".tmp.npy")
+        features = np.lib.format.open_memmap(tmp_features_path, mode="w+", dtype=np.float32,
+                                             shape=(n_cached + len(missing), FEATURE_SIZE))
+        if n_cached:
+            features[:n_cached] = self.features
+
+        data_loader = DataLoader(Subset(dataset, missing), batch_size=batch_size,
+                                 collate_fn=_stack_images, num_workers=num_workers)
+
+        was_training = encoder.training
+        encoder.eval()
+        row = n_cached
+        with torch.no_grad():
+            for images in tqdm(data_loader, desc="Caching resnet features"):
+                trunk_features = encoder.forward_trunk(images.to(device)).float().cpu().numpy()
+                features[row:row + len(trunk_features)] = trunk_features
+                row += len(trunk_features)
+        encoder.train(was_training)
+
+        features.flush()
+        del features
+        self._features = None
+        tmp_features_path.replace(self.features_path)
+
+        for i, idx in enumerate(missing):
+            self.index[dataset.filenames[idx]] = n_cached + i
+        with open(self.index_path, "w") as writer:
+            json.dump(self.index, writer)
+
+
+class CachedFeatureDataset():
+    """Wraps a Pix2CodeDataset and returns cached trunk features instead of images."""
+
+    def __init__(self, dataset, feature_cache):
+        self.dataset = dataset
+        self.feature_cache = feature_cache
+        self.data_path = dataset.data_path
+        self.filenames = dataset.filenames
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return self.feature_cache.get(self.filenames[idx]), self.dataset.get_token_ids(idx)
+
+    def get_token_ids(self, idx):
+        return self.dataset.get_token_ids(idx)
+
+    def get_token_lengths(self):
+        return self.dataset.get_token_lengths()
+
+
+def _stack_images(data):
+    images, _ = zip(*data)
+    return torch.stack(images, 0)
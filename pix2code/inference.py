@@ -0,0 +1,97 @@
+import argparse
+import json
+from pathlib import Path
+import numpy as np
+from PIL import Image
+import torch
+from vocab import Vocab
+from utils import ids_to_tokens, RESNET_MEAN, RESNET_STD
+
+
+class Pix2CodeRuntime():
+    """Runs a model written by export_model.py, without torchvision or network access.
+
+    A file is loaded as a TorchScript module with the greedy loop compiled in, a folder as the
+    ONNX encoder and decoder step graphs, which need onnxruntime.
+    """
+
+    def __init__(self, model_path):
+        model_path = Path(model_path)
+
+        if model_path.is_dir():
+            import onnxruntime
+
+            self.model = None
+            self.encoder_session = onnxruntime.InferenceSession(str(model_path / "encoder.onnx"))
+            self.decoder_step_session = onnxruntime.InferenceSession(str(model_path / "decoder_step.onnx"))
+            with open(model_path / "meta.json", "r") as reader:
+                self.meta = json.load(reader)
+        else:
+            extra_files = {"meta.json": ""}
+            self.model = torch.jit.load(str(model_path), map_location="cpu", _extra_files=extra_files)
+            self.meta = json.loads(extra_files["meta.json"])
+
+        self.vocab = Vocab()
+        for token in self.meta["vocab"]:
+            self.vocab.add_token(token)
+
+        self.img_crop_size = self.meta["img_crop_size"]
+        self.mean = np.array(RESNET_MEAN, dtype=np.float32)
+        self.std = np.array(RESNET_STD, dtype=np.float32)
+
+    def preprocess(self, image):
+        # Same as resnet_img_transformation: resize, scale to [0, 1], normalize and move channels first
+        image = image.convert('RGB').resize((self.img_crop_size, self.img_crop_size), Image.BILINEAR)
+        image = (np.asarray(image, dtype=np.float32) / 255 - self.mean) / self.std
+        return image.transpose(2, 0, 1)
+
+    def predict_ids(self, images):
+        """Greedily decodes a (batch_size, 3, img_crop_size, img_crop_size) float32 array."""
+        if self.model is not None:
+            with torch.no_grad():
+                return self.model(torch.from_numpy(images)).numpy()
+
+        features = self.encoder_session.run(None, {"images": images})[0]
+
+        end_token_id = self.meta["end_token_id"]
+        h = np.zeros((self.meta["num_layers"], len(images), self.meta["hidden_size"]), dtype=np.float32)
+        c = np.zeros_like(h)
+        inputs = features[:, np.newaxis]
+        finished = np.zeros(len(images), dtype=bool)
+
+        sampled_ids = []
+        for i in range(self.meta["max_sentence_length"]):
+            predicted, inputs, h, c = self.decoder_step_session.run(None, {"inputs": inputs, "h": h, "c": c})
+
+            predicted = np.where(finished, end_token_id, predicted)
+            finished |= predicted == end_token_id
+
+            sampled_ids.append(predicted)
+            if finished.all():
+                break
+
+        return np.stack(sampled_ids, 1)
+
+    def predict(self, images):
+        """Converts a list of PIL images to their DSL tokens."""
+        batch = np.stack([self.preprocess(image) for image in images]).astype(np.float32)
+        return ids_to_tokens(self.vocab, self.predict_ids(batch))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the DSL code of screenshots with an exported model')
+
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="TorchScript file or ONNX folder written by export_model.py")
+    parser.add_argument("images", type=str, nargs="+", help="Screenshots to convert")
+    parser.add_argument("--batch_size", type=int, default=8)
+
+    args = parser.parse_args()
+
+    runtime = Pix2CodeRuntime(args.model_path)
+
+    for start in range(0, len(args.images), args.batch_size):
+        image_paths = args.images[start:start + args.batch_size]
+        predictions = runtime.predict([Image.open(image_path) for image_path in image_paths])
+        for image_path, tokens in zip(image_paths, predictions):
+            print(f"{image_path}: {' '.join(tokens)}")
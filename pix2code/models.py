@@ -1,3 +1,4 @@
+from typing import List
 import torch
 import torch.nn as nn
 import torchvision.models as models
@@ -5,11 +6,12 @@ import torchvision.models as models
 
 class Encoder(nn.Module):
 
-    def __init__(self, embedding_size):
+    def __init__(self, embedding_size, pretrained=True):
 
         super(Encoder, self).__init__()
 
-        resnet = models.resnet152(pretrained=True)
+        # Models loaded from a model file do not need the imagenet weights
+        resnet = models.resnet152(pretrained=pretrained)
 
         # Remove the fully connected layers, since we don't need the original resnet classes anymore
         modules = list(resnet.children())[:-1]
@@ -22,10 +24,15 @@ class Encoder(nn.Module):
             num_features=embedding_size, momentum=0.01)
 
     def forward(self, images):
+        return self.forward_head(self.forward_trunk(images))
+
+    def forward_trunk(self, images):
+        # Pooled features of the frozen resnet, shape (batch_size, 2048)
         features = self.resnet(images)
-        features = features.view(features.size(0), -1)
-        features = self.BatchNorm(self.linear(features))
-        return features
+        return features.view(features.size(0), -1)
+
+    def forward_head(self, features):
+        return self.BatchNorm(self.linear(features))
 
 
 class Decoder(nn.Module):
@@ -55,21 +62,176 @@ class Decoder(nn.Module):
 
         return output
 
-    def sample(self, features, states=None, longest_sentence_length=100):
-
+    def sample(self, features, states=None, longest_sentence_length=100, end_token_id=None):
+        """Greedily decodes a whole batch of encoded images at once.
+
+        Args:
+            features: torch tensor of shape (batch_size, embed_size).
+            longest_sentence_length: maximum number of decoding steps, usually the
+                longest token sequence observed in the training split.
+            end_token_id: id of the END token. When given, rows that already emitted
+                END are marked as finished and keep emitting END afterwards, and
+                decoding stops as soon as every row has finished.
+        Returns:
+            sampled_ids: torch tensor of shape (batch_size, <= longest_sentence_length).
+        """
         sampled_ids = []
         inputs = features.unsqueeze(1)
+        finished = torch.zeros(features.size(0), dtype=torch.bool, device=features.device)
 
         for i in range(longest_sentence_length):
 
             hidden, states = self.lstm(inputs, states)
 
             output = self.linear(hidden.squeeze(1))
-            predicted = output.max(dim=1, keepdim=True)[1]
+            predicted = output.argmax(dim=1)
+
+            if end_token_id is not None:
+                # Finished rows are frozen on END so they no longer change the output
+                predicted = predicted.masked_fill(finished, end_token_id)
+                finished = finished | (predicted == end_token_id)
+
             sampled_ids.append(predicted)
-            inputs = self.embed(predicted)
-            inputs = inputs.view(-1, 1, self.embed_size)
+            if finished.all():
+                break
+            inputs = self.embed(predicted).unsqueeze(1)
+
+        sampled_ids = torch.stack(sampled_ids, 1)
+
+        return sampled_ids
+
+    def beam_search(self, features, beam_size=3, longest_sentence_length=100, end_token_id=None,
+                    length_penalty=1.0):
+        """Decodes a whole batch with beam search, keeping all beams in one LSTM call per step.
+
+        Args:
+            features: torch tensor of shape (batch_size, embed_size).
+            beam_size: number of hypotheses kept per image.
+            longest_sentence_length: maximum number of decoding steps.
+            end_token_id: id of the END token. Beams that emitted END are kept frozen and
+                decoding stops as soon as every beam has finished.
+            length_penalty: the final beam is picked by log probability divided by
+                length ** length_penalty, 0 disables the normalization.
+        Returns:
+            sampled_ids: torch tensor of shape (batch_size, <= longest_sentence_length).
+        """
+        batch_size = features.size(0)
+        device = features.device
+
+        # Every image starts with beam_size copies of its features, only the first one is live
+        inputs = features.repeat_interleave(beam_size, dim=0).unsqueeze(1)
+        scores = torch.full((batch_size, beam_size), float("-inf"), device=device)
+        scores[:, 0] = 0.0
+        finished = torch.zeros(batch_size * beam_size, dtype=torch.bool, device=device)
+        lengths = torch.zeros(batch_size * beam_size, dtype=torch.long, device=device)
+        sequences = torch.zeros(batch_size * beam_size, 0, dtype=torch.long, device=device)
+        beam_offsets = (torch.arange(batch_size, device=device) * beam_size).unsqueeze(1)
+        states = None
+
+        for i in range(longest_sentence_length):
+
+            hidden, states = self.lstm(inputs, states)
+
+            log_probs = torch.log_softmax(self.linear(hidden.squeeze(1)), dim=1)
+            vocab_size = log_probs.size(1)
+
+            if end_token_id is not None:
+                # Finished beams can only be extended with END, at no cost
+                log_probs = log_probs.masked_fill(finished.unsqueeze(1), float("-inf"))
+                log_probs[:, end_token_id] = log_probs[:, end_token_id].masked_fill(finished, 0.0)
+
+            candidates = (scores.view(-1, 1) + log_probs).view(batch_size, -1)
+            scores, candidate_ids = candidates.topk(beam_size, dim=1)
+
+            # Map the surviving candidates back to the beam they extend
+            parents = (beam_offsets + candidate_ids // vocab_size).view(-1)
+            predicted = (candidate_ids % vocab_size).view(-1)
+
+            sequences = torch.cat((sequences[parents], predicted.unsqueeze(1)), 1)
+            states = tuple(state[:, parents] for state in states)
+            lengths = lengths[parents] + (~finished[parents]).long()
+            finished = finished[parents]
+
+            if end_token_id is not None:
+                finished = finished | (predicted == end_token_id)
+                if finished.all():
+                    break
+
+            inputs = self.embed(predicted).unsqueeze(1)
+
+        normalized_scores = scores / lengths.view(batch_size, beam_size).float().pow(length_penalty)
+        best_beams = normalized_scores.argmax(dim=1)
+        sampled_ids = sequences.view(batch_size, beam_size, -1)[torch.arange(batch_size, device=device), best_beams]
+
+        return sampled_ids
+
+
+class EncoderDecoder(nn.Module):
+    """Runs the encoder and decoder in one forward, so the training step can be wrapped in DistributedDataParallel.
+
+    With cached_features the inputs are the pooled resnet trunk features instead of images.
+    """
+
+    def __init__(self, encoder, decoder, cached_features=False):
+        super(EncoderDecoder, self).__init__()
+
+        self.encoder = encoder
+        self.decoder = decoder
+        self.cached_features = cached_features
+
+    def forward(self, images, captions, length):
+        features = self.encoder.forward_head(images) if self.cached_features else self.encoder(images)
+        return self.decoder(features, captions, length)
+
+
+class GreedyCaptioner(nn.Module):
+    """Encoder and the greedy loop of Decoder.sample in one scriptable module, used for export."""
+
+    def __init__(self, encoder, decoder, max_sentence_length, end_token_id):
+        super(GreedyCaptioner, self).__init__()
+
+        self.encoder = encoder
+        self.decoder = decoder
+        self.max_sentence_length = max_sentence_length
+        self.end_token_id = end_token_id
+
+    def forward(self, images):
+        features = self.encoder(images)
+        batch_size = features.size(0)
+
+        # Zero states, as the LSTM uses when none are given
+        states = (torch.zeros(self.decoder.lstm.num_layers, batch_size, self.decoder.lstm.hidden_size,
+                              dtype=features.dtype, device=features.device),
+                  torch.zeros(self.decoder.lstm.num_layers, batch_size, self.decoder.lstm.hidden_size,
+                              dtype=features.dtype, device=features.device))
+        inputs = features.unsqueeze(1)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=features.device)
+        sampled_ids: List[torch.Tensor] = []
+
+        for i in range(self.max_sentence_length):
+            hidden, states = self.decoder.lstm(inputs, states)
+
+            predicted = self.decoder.linear(hidden.squeeze(1)).argmax(dim=1)
+            predicted = predicted.masked_fill(finished, self.end_token_id)
+            finished = finished | (predicted == self.end_token_id)
+
+            sampled_ids.append(predicted)
+            if bool(finished.all()):
+                break
+            inputs = self.decoder.embed(predicted).unsqueeze(1)
+
+        return torch.stack(sampled_ids, 1)
+
+
+class DecoderStep(nn.Module):
+    """A single greedy decoding step, exported to ONNX while the loop runs in the inference runtime."""
+
+    def __init__(self, decoder):
+        super(DecoderStep, self).__init__()
 
-        sampled_ids = torch.cat(sampled_ids, 1)
+        self.decoder = decoder
 
-        return sampled_ids.squeeze()
+    def forward(self, inputs, h, c):
+        hidden, (h, c) = self.decoder.lstm(inputs, (h, c))
+        predicted = self.decoder.linear(hidden.squeeze(1)).argmax(dim=1)
+        return predicted, self.decoder.embed(predicted).unsqueeze(1), h, c
@@ -0,0 +1,62 @@
+import argparse
+import json
+from pathlib import Path
+import numpy as np
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from tqdm import tqdm
+from vocab import Vocab
+from dataset import Pix2CodeDataset
+
+parser = argparse.ArgumentParser(description='Pack the dataset splits into memory-mapped arrays read by PackedPix2CodeDataset')
+
+parser.add_argument("--data_path", type=str,
+                        default=Path("data", "web", "all_data"), help="Datapath")
+parser.add_argument("--vocab_file_path", type=str,
+                        default=None, help="Path to the vocab file")
+parser.add_argument("--packed_path", type=str,
+                        default=None, help="Output folder of the packed dataset")
+parser.add_argument("--img_crop_size", type=int, default=224)
+parser.add_argument("--splits", type=str, nargs="+",
+                        default=["train", "validation", "test"], help="Splits to pack")
+parser.add_argument("--num_workers", type=int, default=4)
+
+args = parser.parse_args()
+args.vocab_file_path = args.vocab_file_path if args.vocab_file_path else Path(Path(args.data_path).parent, "vocab.txt")
+args.packed_path = args.packed_path if args.packed_path else Path(Path(args.data_path).parent, "packed")
+
+packed_path = Path(args.packed_path)
+packed_path.mkdir(parents=True, exist_ok=True)
+
+vocab = Vocab(args.vocab_file_path)
+
+# Same resize as resnet_img_transformation, the normalization is applied when reading
+transform_imgs = transforms.Compose([transforms.Resize((args.img_crop_size, args.img_crop_size)),
+                                     transforms.PILToTensor()])
+
+for split in args.splits:
+    dataset = Pix2CodeDataset(args.data_path, split, vocab, transform=transform_imgs)
+
+    images = np.lib.format.open_memmap(packed_path / f'{split}_images.npy', mode="w+", dtype=np.uint8,
+                                       shape=(len(dataset), 3, args.img_crop_size, args.img_crop_size))
+    offsets = np.zeros(len(dataset) + 1, dtype=np.int64)
+    token_ids = []
+
+    data_loader = DataLoader(dataset, batch_size=None, num_workers=args.num_workers)
+    for i, (image, ids) in enumerate(tqdm(data_loader, desc=f'Packing {split}')):
+        images[i] = image.numpy()
+        offsets[i + 1] = offsets[i] + len(ids)
+        token_ids.append(ids.numpy().astype(np.int32))
+
+    images.flush()
+    del images
+    np.save(packed_path / f'{split}_token_ids.npy', np.concatenate(token_ids) if token_ids else np.zeros(0, dtype=np.int32))
+    np.save(packed_path / f'{split}_offsets.npy', offsets)
+
+    with open(packed_path / f'{split}_meta.json', "w") as writer:
+        json.dump({"data_path": str(Path(args.data_path).absolute()),
+                   "filenames": dataset.filenames,
+                   "img_crop_size": args.img_crop_size,
+                   "vocab": [vocab.get_token_by_id(id) for id in range(len(vocab))]}, writer)
+
+    print(f'Packed {len(dataset)} examples of the {split} split into {packed_path}')
@@ -0,0 +1,43 @@
+import copy
+import inspect
+import torch
+import torch.nn as nn
+
+
+def quantize_dynamic(encoder, decoder):
+    """Returns int8 dynamically quantized copies of the models for CPU inference.
+
+    The decoder LSTM and linear projection and the encoder linear head are quantized, the
+    resnet trunk has no linear layers and is left as it is.
+    """
+    encoder = torch.quantization.quantize_dynamic(copy.deepcopy(encoder).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+    decoder = torch.quantization.quantize_dynamic(copy.deepcopy(decoder).cpu().eval(), {nn.LSTM, nn.Linear},
+                                                  dtype=torch.qint8)
+    return encoder, decoder
+
+
+def quantize_static_trunk(encoder, calibration_images):
+    """Statically quantizes the resnet trunk of a copy of the encoder to int8 with FX graph mode.
+
+    Args:
+        encoder: the (possibly dynamically quantized) encoder.
+        calibration_images: iterable of image batches used to observe the activation ranges.
+    """
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+    encoder = copy.deepcopy(encoder).cpu().eval()
+    qconfig = torch.quantization.get_default_qconfig("fbgemm")
+
+    calibration_images = [images.cpu() for images in calibration_images]
+    # Newer torch versions need example inputs to trace the trunk
+    if "example_inputs" in inspect.signature(prepare_fx).parameters:
+        prepared = prepare_fx(encoder.resnet, {"": qconfig}, example_inputs=(calibration_images[0],))
+    else:
+        prepared = prepare_fx(encoder.resnet, {"": qconfig})
+
+    with torch.no_grad():
+        for images in calibration_images:
+            prepared(images)
+
+    encoder.resnet = convert_fx(prepared)
+    return encoder
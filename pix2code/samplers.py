@@ -0,0 +1,78 @@
+import torch
+
+
+class BucketBatchSampler():
+    """Batch sampler grouping samples of similar token length to reduce padding.
+
+    Every epoch the indices are shuffled and split into pools of pool_size samples. Each pool is
+    sorted by length and cut into batches, and the batches of all pools are shuffled again.
+    Without shuffling the whole dataset is one pool, so the batches are ordered by length.
+
+    Args:
+        lengths: token length of every sample of the dataset.
+        batch_size: maximum number of samples per batch.
+        max_tokens: maximum number of padded tokens per batch (samples * longest length).
+            Can be combined with batch_size, at least one of the two has to be set.
+        pool_size: number of samples sorted together, defaults to 100 batches worth.
+        num_replicas, rank: for distributed training every rank builds the same batches from the
+            shared seed and keeps every num_replicas-th one, so all ranks run the same number of steps.
+    """
+
+    def __init__(self, lengths, batch_size=None, max_tokens=None, pool_size=None, shuffle=True,
+                 drop_last=False, seed=0, num_replicas=1, rank=0):
+        assert batch_size or max_tokens, "Either batch_size or max_tokens is required"
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size if pool_size else 100 * (batch_size or 1)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+            pools = [indices[i:i + self.pool_size] for i in range(0, len(indices), self.pool_size)]
+        else:
+            pools = [list(range(len(self.lengths)))]
+
+        batches = []
+        for pool in pools:
+            pool.sort(key=lambda idx: self.lengths[idx], reverse=True)
+            batch = []
+            for idx in pool:
+                # Sorted by decreasing length, so the first sample of a batch is the longest one
+                too_many_tokens = self.max_tokens and batch and \
+                    (len(batch) + 1) * self.lengths[batch[0]] > self.max_tokens
+                if too_many_tokens or len(batch) == self.batch_size:
+                    batches.append(batch)
+                    batch = []
+                batch.append(idx)
+            if batch and not (self.drop_last and self.batch_size and len(batch) < self.batch_size):
+                batches.append(batch)
+
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in order]
+
+        if self.num_replicas > 1:
+            # Drop the tail so that every rank gets the same number of batches
+            n_batches = len(batches) - len(batches) % self.num_replicas
+            batches = batches[self.rank:n_batches:self.num_replicas]
+
+        return batches
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        return len(self._batches())
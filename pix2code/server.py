@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import http
+import io
+import json
+import logging
+import time
+from pathlib import Path
+from PIL import Image
+import torch
+from utils import ids_to_tokens, resnet_img_transformation
+from models import Encoder, Decoder
+from encoder_cache import EncoderCache
+
+logger = logging.getLogger(__name__)
+
+
+class BadRequest(Exception):
+    """Malformed request or image, answered with a 400. Any other error is a server failure, answered with a 500."""
+
+# Upper bounds of the histogram buckets, the last bucket counts everything above
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+class Histogram():
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.n = 0
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.total += value
+        self.n += 1
+
+    def to_dict(self):
+        labels = [f"<={bound}" for bound in self.buckets] + [f">{self.buckets[-1]}"]
+        return {"buckets": dict(zip(labels, self.counts)), "count": self.n,
+                "mean": self.total / self.n if self.n else None}
+
+
+class BatchingPredictor():
+    """Coalesces concurrent requests into micro-batches for one batched Decoder.sample call.
+
+    A batch is run as soon as max_batch_size images are queued, or max_wait_ms after its first
+    image arrived. Inference runs in a worker thread so the event loop keeps accepting requests.
+    With an EncoderCache, repeated screenshots skip the encoder, or the whole inference when
+    the cache also keeps the decoded outputs.
+    """
+
+    def __init__(self, encoder, decoder, vocab, device, max_sentence_length, max_batch_size=16, max_wait_ms=10,
+                 cache=None):
+        self.encoder = encoder
+        self.decoder = decoder
+        self.vocab = vocab
+        self.device = device
+        self.max_sentence_length = max_sentence_length
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.end_token_id = vocab.get_id_by_token(vocab.get_end_token())
+        self.cache = cache
+
+        self.queue = asyncio.Queue()
+        self.batch_sizes = Histogram(list(range(1, max_batch_size + 1)))
+        self.latencies = Histogram(LATENCY_BUCKETS_MS)
+
+    async def predict(self, image):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            images, futures = zip(*batch)
+            self.batch_sizes.observe(len(batch))
+            try:
+                predictions = await loop.run_in_executor(None, self._predict_batch, images)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for future, tokens in zip(futures, predictions):
+                if not future.done():
+                    future.set_result(tokens)
+
+    def _predict_batch(self, images):
+        if self.cache is None:
+            with torch.no_grad():
+                features = self.encoder(torch.stack(images).to(self.device))
+            return self._decode(features)
+
+        keys = [self.cache.key(image) for image in images]
+        predictions = [self.cache.get_output(key) for key in keys]
+        misses = [i for i, tokens in enumerate(predictions) if tokens is None]
+        if misses:
+            with torch.no_grad():
+                features = self.cache.encode(self.encoder, [images[i] for i in misses],
+                                             [keys[i] for i in misses], self.device)
+            for i, tokens in zip(misses, self._decode(features)):
+                predictions[i] = tokens
+                self.cache.put_output(keys[i], tokens)
+        return predictions
+
+    def _decode(self, features):
+        with torch.no_grad():
+            sample_ids = self.decoder.sample(features, longest_sentence_length=self.max_sentence_length,
+                                             end_token_id=self.end_token_id)
+        return ids_to_tokens(self.vocab, sample_ids.cpu().numpy())
+
+
+class Pix2CodeServer():
+    """Minimal HTTP/1.1 service, one request per connection.
+
+    POST /predict with the raw screenshot as body returns {"tokens": [...]},
+    GET /metrics returns the latency and batch size histograms and the cache counters, GET /health returns ok.
+    """
+
+    def __init__(self, predictor, transform, max_body_size=20 * 1024 * 1024):
+        self.predictor = predictor
+        self.transform = transform
+        self.max_body_size = max_body_size
+
+    async def read_request(self, reader):
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+            headers = dict()
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, value = line.decode("latin-1").split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+
+            content_length = int(headers.get("content-length", 0))
+            if content_length > self.max_body_size:
+                return method, path, None
+            return method, path, await reader.readexactly(content_length)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            raise BadRequest(f"Malformed request: {e}") from e
+
+    async def handle_connection(self, reader, writer):
+        try:
+            method, path, body = await self.read_request(reader)
+            if body is None:
+                status, response = 413, {"error": "Request body too large"}
+            else:
+                status, response = await self.route(method, path, body)
+        except BadRequest as e:
+            status, response = 400, {"error": str(e)}
+        except Exception as e:
+            # Inference failures (out of memory, broken checkpoint) are not the fault of the client, which may retry
+            logger.exception("Request failed")
+            status, response = 500, {"error": f"Internal server error: {e}"}
+
+        payload = json.dumps(response).encode()
+        writer.write(f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                     "Connection: close\r\n\r\n".encode("latin-1") + payload)
+        await writer.drain()
+        writer.close()
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+
+        if method == "GET" and path == "/metrics":
+            metrics = {"latency_ms": self.predictor.latencies.to_dict(),
+                       "batch_size": self.predictor.batch_sizes.to_dict()}
+            if self.predictor.cache is not None:
+                metrics["cache"] = self.predictor.cache.stats()
+            return 200, metrics
+
+        if method == "POST" and path == "/predict":
+            start = time.perf_counter()
+            # Decoding and resizing the image does not need the event loop
+            image = await asyncio.get_running_loop().run_in_executor(None, self.preprocess, body)
+            tokens = await self.predictor.predict(image)
+            self.predictor.latencies.observe((time.perf_counter() - start) * 1000)
+            return 200, {"tokens": tokens}
+
+        return 404, {"error": f"No route for {method} {path}"}
+
+    def preprocess(self, body):
+        try:
+            image = Image.open(io.BytesIO(body)).convert('RGB')
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise BadRequest(f"Cannot decode the image: {e}") from e
+        return self.transform(image)
+
+
+async def serve(server, predictor, host, port):
+    batching_task = asyncio.ensure_future(predictor.run())
+    tcp_server = await asyncio.start_server(server.handle_connection, host, port)
+    print(f"Serving on http://{host}:{port}")
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        batching_task.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a trained model over HTTP with dynamic request batching')
+
+    parser.add_argument("--model_file_path", type=str,
+                        help="Path to the trained model file", required=True)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cuda", action='store_true',
+                        default=False, help="Use cuda or not")
+    parser.add_argument("--img_crop_size", type=int, default=224)
+    parser.add_argument("--max_batch_size", type=int, default=16, help="Maximum number of requests per batch")
+    parser.add_argument("--max_wait_ms", type=float, default=10,
+                        help="Maximum time the first request of a batch waits for more requests")
+    parser.add_argument("--cache_size", type=int, default=0,
+                        help="Number of screenshots whose encoder features are cached, 0 disables the cache")
+    parser.add_argument("--cache_hash_size", type=int, default=32,
+                        help="Side of the perceptual hash grid, larger values tell more similar screenshots apart")
+    parser.add_argument("--cache_outputs", action='store_true', default=False,
+                        help="Also cache the decoded tokens, so repeated screenshots skip the decoder")
+
+    args = parser.parse_args()
+
+    use_cuda = args.cuda and torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+
+    # Loading the model
+    embed_size = 256
+    hidden_size = 512
+    num_layers = 1
+
+    assert Path(args.model_file_path).exists()
+    loaded_model = torch.load(args.model_file_path, map_location=device)
+
+    vocab = loaded_model["vocab"]
+    max_sentence_length = loaded_model.get("max_sentence_length") or 100
+
+    encoder = Encoder(embed_size, pretrained=False)
+    decoder = Decoder(embed_size, hidden_size, len(vocab), num_layers)
+
+    encoder.load_state_dict(loaded_model["encoder_model_state_dict"])
+    decoder.load_state_dict(loaded_model["decoder_model_state_dict"])
+
+    encoder = encoder.to(device).eval()
+    decoder = decoder.to(device).eval()
+
+    cache = None
+    if args.cache_size > 0:
+        cache = EncoderCache(args.cache_size, hash_size=args.cache_hash_size, cache_outputs=args.cache_outputs)
+
+    async def main():
+        predictor = BatchingPredictor(encoder, decoder, vocab, device, max_sentence_length,
+                                      max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                                      cache=cache)
+        server = Pix2CodeServer(predictor, resnet_img_transformation(args.img_crop_size))
+        await serve(server, predictor, args.host, args.port)
+
+    asyncio.run(main())
@@ -24,7 +24,7 @@ for file in Path(data_path).iterdir():
         count[suffix] = 1
         occurences_count[stem] = count
     else:
-        occurences_count[stem][suffix] = occurences_count[stem][suffix] =+ 1
+        occurences_count[stem][suffix] = occurences_count[stem].get(suffix, 0) + 1
 
 # map to array only containing valid pairs
 valid_pairs = []
@@ -2,12 +2,21 @@ import argparse
 import torch
 import math
 import os
+import json
+import time
+import contextlib
+import datetime
 from pathlib import Path
 from vocab import Vocab
 from torch.utils.data import DataLoader
-from dataset import Pix2CodeDataset
-from utils import collate_fn, save_model, resnet_img_transformation
-from models import Encoder, Decoder
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+import torch.distributed as dist
+from dataset import Pix2CodeDataset, PackedPix2CodeDataset
+from utils import PaddedBatchCollator, CheckpointWriter, load_checkpoint, resnet_img_transformation, autocast_context
+from models import Encoder, Decoder, EncoderDecoder
+from feature_cache import FeatureCache, CachedFeatureDataset
+from samplers import BucketBatchSampler
 import torch.multiprocessing as mp
 
 # Fix multiprocessing issues on Windows
@@ -31,6 +40,36 @@ if __name__ == '__main__':
     parser.add_argument("--epochs", type=int, default=15)
     parser.add_argument("--lr", type=float, default=1e-3, help="Learning rate")
     parser.add_argument("--print_freq", type=int, default=1, help="Print training stats every n epochs")
+    parser.add_argument("--packed_path", type=str, default=None,
+                        help="Read the split from the memory-mapped arrays written by pack_dataset.py")
+    parser.add_argument("--features_cache_dir", type=str, default=None,
+                        help="Cache the frozen resnet features in this directory and train only the encoder head. "
+                             "The features are computed with the resnet batch norms in eval mode, while without the "
+                             "cache they use batch statistics, so results differ unless --trunk_eval is given")
+    parser.add_argument("--trunk_eval", action='store_true', default=False,
+                        help="Run the frozen resnet trunk in eval mode, its batch norms use their running statistics "
+                             "as the cached features do")
+    parser.add_argument("--bucket_by_length", action='store_true', default=False,
+                        help="Batch together programs of similar token length to reduce padding")
+    parser.add_argument("--max_tokens", type=int, default=None,
+                        help="Token budget per batch when bucketing by length, batch_size still caps the samples")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"],
+                        help="Autocast precision, fp16 needs CUDA and uses a gradient scaler")
+    parser.add_argument("--channels_last", action='store_true', default=False,
+                        help="Run the resnet trunk in channels-last memory format")
+    parser.add_argument("--resume", type=str, default=None,
+                        help="Model file to resume training from, restores the optimizer, epoch and RNG state")
+    parser.add_argument("--keep_checkpoints", type=int, default=None,
+                        help="Only keep the newest n checkpoints of this run")
+    parser.add_argument("--num_workers", type=int, default=None,
+                        help="DataLoader workers, defaults to 4 with CUDA and 0 otherwise")
+    parser.add_argument("--accumulation_steps", type=int, default=1,
+                        help="Number of batches whose gradients are accumulated before each optimizer step")
+    parser.add_argument("--distributed", action='store_true', default=False,
+                        help="DistributedDataParallel training, launch with torchrun")
+    parser.add_argument("--dist_backend", type=str, default="gloo", help="torch.distributed backend")
+    parser.add_argument("--cache_build_timeout", type=float, default=24,
+                        help="Hours the other ranks wait for rank 0 to build the feature cache in distributed runs")
     parser.add_argument("--seed", type=int, default=2020, help="Random seed for reproducibility")
 
     args = parser.parse_args()
@@ -38,7 +77,19 @@ if __name__ == '__main__':
 
     print("Training args:", args)
 
-    # Set seeds for reproducibility
+    if args.precision == "fp16" and not (args.cuda and torch.cuda.is_available()):
+        parser.error("fp16 training needs CUDA, use bf16 on CPU")
+
+    # Rank and world size come from the torchrun environment
+    if args.distributed:
+        dist.init_process_group(backend=args.dist_backend)
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+        print(f"Process {rank} of {world_size} initialized with the {args.dist_backend} backend")
+    else:
+        rank, world_size, local_rank = 0, 1, 0
+
+    # Set seeds for reproducibility, identical on all ranks so the models start equal
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed(args.seed)
 
@@ -48,7 +99,7 @@ if __name__ == '__main__':
 
     # Setup GPU/CPU
     use_cuda = args.cuda and torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
+    device = torch.device(f"cuda:{local_rank}" if use_cuda and args.distributed else "cuda" if use_cuda else "cpu")
 
     if use_cuda:
         print(f"Using GPU: {torch.cuda.get_device_name(0)}")
@@ -59,18 +110,10 @@ if __name__ == '__main__':
     transform_imgs = resnet_img_transformation(args.img_crop_size)
 
     # Adjust num_workers based on OS
-    num_workers = 4 if use_cuda and os.name != 'nt' else 0
-
-    # Creating the DataLoader
-    train_loader = DataLoader(
-        Pix2CodeDataset(args.data_path, args.split, vocab, transform=transform_imgs),
-        batch_size=args.batch_size,
-        collate_fn=lambda data: collate_fn(data, vocab=vocab),
-        pin_memory=use_cuda,
-        num_workers=num_workers,
-        drop_last=True
-    )
-    print("DataLoader initialized.")
+    if args.num_workers is not None:
+        num_workers = args.num_workers
+    else:
+        num_workers = 4 if use_cuda and os.name != 'nt' else 0
 
     # Define model parameters
     embed_size = 256
@@ -82,38 +125,181 @@ if __name__ == '__main__':
     encoder = Encoder(embed_size).to(device)
     decoder = Decoder(embed_size, hidden_size, len(vocab), num_layers).to(device)
 
+    # The resnet trunk is frozen, skipping its gradients also keeps it out of the DDP all-reduce
+    encoder.resnet.requires_grad_(False)
+
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    encoder.resnet = encoder.resnet.to(memory_format=memory_format)
+
+    # Creating the DataLoader
+    if args.packed_path:
+        train_dataset = PackedPix2CodeDataset(args.packed_path, args.split, vocab)
+        assert train_dataset.img_crop_size == args.img_crop_size, "The dataset was packed with another crop size"
+    else:
+        train_dataset = Pix2CodeDataset(args.data_path, args.split, vocab, transform=transform_imgs)
+
+    # Longest token sequence of the split, stored with the model to cap decoding at inference
+    token_lengths = train_dataset.get_token_lengths()
+    max_sentence_length = max(token_lengths)
+    print(f"Longest token sequence: {max_sentence_length}")
+
+    if args.features_cache_dir:
+        # The resnet trunk is frozen, so its features are computed once and only the head is trained
+        if args.distributed:
+            # Building the cache can take hours on CPU nodes, longer than the default timeout of the process group,
+            # so the other ranks wait on a group of their own and training keeps the default timeout.
+            # Creating a group is collective, so it is done before rank 0 starts building
+            cache_group = dist.new_group(backend="gloo", timeout=datetime.timedelta(hours=args.cache_build_timeout))
+        if rank == 0:
+            FeatureCache(args.features_cache_dir, train_dataset.data_path, args.img_crop_size).build(
+                encoder, train_dataset, device, args.batch_size, num_workers)
+        if args.distributed:
+            dist.barrier(group=cache_group)
+        feature_cache = FeatureCache(args.features_cache_dir, train_dataset.data_path, args.img_crop_size)
+        train_dataset = CachedFeatureDataset(train_dataset, feature_cache)
+        print(f"Using {len(feature_cache)} cached resnet features from {args.features_cache_dir}")
+
+    if args.trunk_eval:
+        # After building the cache, which restores the training mode of the whole encoder
+        encoder.resnet.eval()
+
+    # Without workers the batches are collated on the training thread, so the buffers can be reused
+    collator = PaddedBatchCollator(vocab, reuse_buffers=num_workers == 0, pin_memory=use_cuda and num_workers == 0)
+
+    if args.bucket_by_length:
+        batch_sampler = BucketBatchSampler(token_lengths, batch_size=args.batch_size, max_tokens=args.max_tokens,
+                                           drop_last=True, seed=args.seed, num_replicas=world_size, rank=rank)
+        train_loader = DataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=collator,
+            pin_memory=use_cuda,
+            num_workers=num_workers
+        )
+    else:
+        # Each rank reads its own shard of the split
+        batch_sampler = None
+        sampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=rank, shuffle=False,
+                                     drop_last=True) if args.distributed else None
+        train_loader = DataLoader(
+            train_dataset,
+            batch_size=args.batch_size,
+            sampler=sampler,
+            collate_fn=collator,
+            pin_memory=use_cuda,
+            num_workers=num_workers,
+            drop_last=True
+        )
+    print("DataLoader initialized.")
+
+    # The whole training forward is one module, so DDP sees every trained parameter
+    model = EncoderDecoder(encoder, decoder, cached_features=bool(args.features_cache_dir))
+    if args.distributed:
+        model = DistributedDataParallel(model, device_ids=[device.index] if use_cuda else None)
+        print(f"Effective batch size: {args.batch_size * world_size * args.accumulation_steps}")
+
     # Define optimizer and loss function
     criterion = torch.nn.CrossEntropyLoss()
     params = list(decoder.parameters()) + list(encoder.linear.parameters()) + list(encoder.BatchNorm.parameters())
     optimizer = torch.optim.Adam(params, lr=lr)
 
+    # Loss scaling is only needed for fp16, the scaler is a no-op otherwise
+    scaler = torch.cuda.amp.GradScaler(enabled=args.precision == "fp16")
+
+    # Throughput and mean loss of every epoch, to compare the precision modes
+    stats_path = Path(args.models_dir, "training_stats.jsonl")
+    if rank == 0:
+        Path(args.models_dir).mkdir(parents=True, exist_ok=True)
+
+    start_epoch = 0
+    last_loss = float("nan")
+    if args.resume:
+        checkpoint = load_checkpoint(args.resume, encoder, decoder, optimizer, scaler)
+        start_epoch = checkpoint["epoch"] + 1
+        last_loss = checkpoint["loss"]
+        print(f"Resuming from {args.resume} at epoch {start_epoch}")
+
+    # Checkpoints are serialized in the background while training goes on
+    checkpoint_writer = CheckpointWriter(args.models_dir, keep_last=args.keep_checkpoints)
+
     # Training loop
     print("Starting Training...")
-    for epoch in range(args.epochs):
+    for epoch in range(start_epoch, args.epochs):
+        if batch_sampler:
+            batch_sampler.set_epoch(epoch)
+        elif args.distributed:
+            train_loader.sampler.set_epoch(epoch)
+
+        epoch_start = time.time()
+        epoch_loss = 0.0
+        n_samples = 0
+        batches_done = 0
+
+        # The last accumulation cycle of an epoch may be shorter, it is stepped with its own length
+        n_batches = len(train_loader)
+        optimizer.zero_grad()
+
         for i, (images, captions, lengths) in enumerate(train_loader):
-            images, captions = images.to(device), captions.to(device)
+            if images.dim() == 4:
+                images = images.to(device, memory_format=memory_format)
+            else:
+                images = images.to(device)
+            captions = captions.to(device)
 
             targets = torch.nn.utils.rnn.pack_padded_sequence(input=captions, lengths=lengths, batch_first=True)[0]
 
-            encoder.zero_grad()
-            decoder.zero_grad()
+            # Gradients are only all-reduced on the last batch of an accumulation cycle
+            cycle_start = i - i % args.accumulation_steps
+            cycle_length = min(args.accumulation_steps, n_batches - cycle_start)
+            accumulating = i + 1 < cycle_start + cycle_length
+            sync_context = model.no_sync() if args.distributed and accumulating else contextlib.nullcontext()
+
+            with sync_context:
+                with autocast_context(device, args.precision):
+                    output = model(images, captions, lengths)
+                    loss = criterion(output.float(), targets)
 
-            features = encoder(images)
-            output = decoder(features, captions, lengths)
-            loss = criterion(output, targets)
+                scaler.scale(loss / cycle_length).backward()
 
-            loss.backward()
-            optimizer.step()
+            if not accumulating:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
 
-            if epoch % args.print_freq == 0 and i == 0:
+            epoch_loss += loss.detach()
+            n_samples += len(lengths)
+            batches_done += 1
+
+            if epoch % args.print_freq == 0 and i == 0 and rank == 0:
                 print(f"Epoch {epoch} | Loss: {loss.item():.4f} | Perplexity: {math.exp(loss.item()):.4f}")
 
+        if batches_done == 0:
+            # Small datasets can give no batch at all with length bucketing or a large batch size
+            print(f"Epoch {epoch} | No batch, check --batch_size and --max_tokens")
+        else:
+            last_loss = loss.item()
+        if rank == 0 and batches_done > 0:
+            # Loss of the first rank, throughput of all ranks
+            epoch_stats = {"epoch": epoch, "precision": args.precision, "channels_last": args.channels_last,
+                           "world_size": world_size, "mean_loss": float(epoch_loss) / batches_done,
+                           "samples_per_second": n_samples * world_size / (time.time() - epoch_start)}
+            print(f"Epoch {epoch} | Mean loss: {epoch_stats['mean_loss']:.4f} | "
+                  f"Samples/s: {epoch_stats['samples_per_second']:.2f}")
+            with open(stats_path, "a") as writer:
+                writer.write(json.dumps(epoch_stats) + "\n")
+
         # Save model checkpoint
         if epoch != 0 and epoch % args.save_after_epochs == 0:
-            save_model(args.models_dir, encoder, decoder, optimizer, epoch, loss.item(), args.batch_size, vocab)
-            print(f"Checkpoint saved at epoch {epoch}")
+            if checkpoint_writer.save(encoder, decoder, optimizer, epoch, last_loss, args.batch_size, vocab,
+                                      max_sentence_length, scaler):
+                print(f"Checkpoint saved at epoch {epoch}")
 
     # Save final model
     print("Training Complete!")
-    save_model(args.models_dir, encoder, decoder, optimizer, args.epochs, loss.item(), args.batch_size, vocab)
+    checkpoint_writer.save(encoder, decoder, optimizer, args.epochs, last_loss, args.batch_size, vocab,
+                           max_sentence_length, scaler)
+    checkpoint_writer.close()
     print("Final model saved.")
+
+    if args.distributed:
+        dist.destroy_process_group()
@@ -2,15 +2,20 @@ import platform
 import os
 import subprocess
 import time
+import random
+import queue
+import threading
 import torch
+import torch.distributed as dist
 from pathlib import Path
 import pickle
-from torchvision import transforms
+import contextlib
+import numpy as np
 
 # Taken from: https://github.com/yunjey/pytorch-tutorial/blob/0500d3df5a2a8080ccfccbc00aca0eacc21818db/tutorials/03-advanced/image_captioning/data_loader.py#L56
 
 
-def collate_fn(data=None, vocab=None):
+def collate_fn(data=None, vocab=None, sort_by_length=True):
     """Creates mini-batch tensors from the list of tuples (image, caption).
 
     We should build custom collate_fn rather than using default collate_fn, 
@@ -19,57 +24,244 @@ def collate_fn(data=None, vocab=None):
         data: list of tuple (image, caption). 
             - image: torch tensor of shape (3, 256, 256).
             - caption: torch tensor of shape (?); variable length.
+        sort_by_length: sort the batch by caption length, as required by pack_padded_sequence.
+            Evaluation disables it to keep the dataset order.
     Returns:
         images: torch tensor of shape (batch_size, 3, 256, 256).
         targets: torch tensor of shape (batch_size, padded_length).
-        lengths: list; valid length for each padded caption.
+        lengths: torch tensor of shape (batch_size); valid length for each padded caption.
     """
     # Vocab is neccessary to get the ID of the padding token
     assert vocab
 
-    # Sort a data list by caption length (descending order).
-    data.sort(key=lambda x: len(x[1]), reverse=True)
-    images, captions = zip(*data)
+    return PaddedBatchCollator(vocab, sort_by_length=sort_by_length)(data)
 
-    # Merge images (from tuple of 3D tensor to 4D tensor).
-    images = torch.stack(images, 0)
 
-    # Merge captions (from tuple of 1D tensor to 2D tensor).
-    lengths = [len(cap) for cap in captions]
-    padding_token_id = vocab.get_id_by_token(vocab.get_padding_token())
-    # Initalize a tensor with the id of the padding token
-    targets = torch.ones(len(captions), max(lengths)).long() * padding_token_id
-    for i, cap in enumerate(captions):
-        end = lengths[i]
-        targets[i, :end] = cap[:end]
-    return images, targets, lengths
+class PaddedBatchCollator():
+    """collate_fn writing images and padded captions straight into preallocated tensors.
+
+    With reuse_buffers the output tensors are views of buffers that are kept and only grown
+    between batches, so a batch is only valid until the next one is collated. This is only
+    safe with num_workers=0 and synchronous copies to the device. With pin_memory the buffers
+    are allocated in page-locked memory so the DataLoader does not copy them again.
+    """
+
+    def __init__(self, vocab, sort_by_length=True, reuse_buffers=False, pin_memory=False):
+        self.padding_token_id = vocab.get_id_by_token(vocab.get_padding_token())
+        self.sort_by_length = sort_by_length
+        self.reuse_buffers = reuse_buffers
+        self.pin_memory = pin_memory
+
+        self._images = None
+        self._targets = None
+
+    def __getstate__(self):
+        # Buffers are never shared with DataLoader workers
+        state = self.__dict__.copy()
+        state.update(_images=None, _targets=None)
+        return state
+
+    def _get_buffer(self, buffer, numel, dtype):
+        if self.reuse_buffers and buffer is not None and buffer.dtype == dtype and buffer.numel() >= numel:
+            return buffer
+        return torch.empty(numel, dtype=dtype, pin_memory=self.pin_memory)
+
+    def __call__(self, data):
+        # Sort a data list by caption length (descending order).
+        if self.sort_by_length:
+            data.sort(key=lambda x: len(x[1]), reverse=True)
+        images, captions = zip(*data)
+
+        lengths = torch.tensor([len(cap) for cap in captions], dtype=torch.long)
+        batch_size, max_length = len(captions), int(lengths.max())
+        image_shape, image_numel = (batch_size,) + tuple(images[0].shape), batch_size * images[0].numel()
+
+        # Merge images (from tuple of 3D tensor to 4D tensor) directly into the buffer.
+        self._images = self._get_buffer(self._images, image_numel, images[0].dtype)
+        images = torch.stack(images, 0, out=self._images[:image_numel].view(image_shape))
+
+        # Merge captions (from tuple of 1D tensor to 2D tensor) into a buffer filled with padding.
+        self._targets = self._get_buffer(self._targets, batch_size * max_length, torch.long)
+        targets = self._targets[:batch_size * max_length].view(batch_size, max_length)
+        targets.fill_(self.padding_token_id)
+        for i, cap in enumerate(captions):
+            targets[i, :len(cap)].copy_(cap)
+
+        return images, targets, lengths
+
 
 # Image transformation function for resnet152: https://pytorch.org/docs/stable/torchvision/models.html
+RESNET_MEAN = [0.485, 0.456, 0.406]
+RESNET_STD = [0.229, 0.224, 0.225]
 
 
 def resnet_img_transformation(img_crop_size):
+    # Imported here so the inference runtime can use the other utils without torchvision
+    from torchvision import transforms
+
     return transforms.Compose([transforms.Resize((img_crop_size, img_crop_size)),
                                transforms.ToTensor(),
-                               transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                                    std=[0.229, 0.224, 0.225])])
+                               transforms.Normalize(mean=RESNET_MEAN,
+                                                    std=RESNET_STD)])
+
+
+AUTOCAST_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
 
+def autocast_context(device, precision):
+    """Autocast context for the bf16/fp16 training modes, fp32 runs without autocast."""
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=AUTOCAST_DTYPES[precision])
 
-def save_model(models_folder_path, encoder, decoder, optimizer, epoch, loss, batch_size, vocab):
+
+def is_main_process():
+    """Only the first rank writes model files when training is distributed."""
+    return not (dist.is_available() and dist.is_initialized()) or dist.get_rank() == 0
+
+
+def save_model(models_folder_path, encoder, decoder, optimizer, epoch, loss, batch_size, vocab,
+               max_sentence_length=None, scaler=None):
+    if not is_main_process():
+        return None
+
+    MODEL_PATH = model_path(models_folder_path, epoch, loss, batch_size)
+
+    torch.save(model_checkpoint(encoder, decoder, optimizer, epoch, loss, vocab, max_sentence_length, scaler),
+               MODEL_PATH)
+
+    return MODEL_PATH
+
+
+def model_path(models_folder_path, epoch, loss, batch_size):
     MODELS_FOLDER = Path(models_folder_path)
 
     # Create the models folder if it's not already there
     MODELS_FOLDER.mkdir(parents=True, exist_ok=True)
 
-    MODEL_PATH = MODELS_FOLDER / (model_name_formated("e-d-model",
-                                  {"epoch": epoch, "loss": loss, "batch": batch_size}) + ".pth")
+    return MODELS_FOLDER / (model_name_formated("e-d-model",
+                            {"epoch": epoch, "loss": loss, "batch": batch_size}) + ".pth")
+
+
+def model_checkpoint(encoder, decoder, optimizer, epoch, loss, vocab, max_sentence_length=None, scaler=None):
+    return {'epoch': epoch,
+            'encoder_model_state_dict': encoder.state_dict(),
+            'decoder_model_state_dict': decoder.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scaler_state_dict': scaler.state_dict() if scaler else None,
+            'loss': loss,
+            'vocab': vocab,
+            'max_sentence_length': max_sentence_length,
+            'rng_state': {'torch': torch.get_rng_state(),
+                          'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                          'python': random.getstate(),
+                          'numpy': np.random.get_state()}
+            }
+
+
+def load_checkpoint(model_file_path, encoder, decoder, optimizer=None, scaler=None):
+    """Restores the models, and optionally the optimizer, scaler and RNG state, from a saved model file."""
+    checkpoint = torch.load(model_file_path, map_location="cpu")
+
+    encoder.load_state_dict(checkpoint["encoder_model_state_dict"])
+    decoder.load_state_dict(checkpoint["decoder_model_state_dict"])
+
+    if optimizer:
+        optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+    if scaler and checkpoint.get("scaler_state_dict"):
+        scaler.load_state_dict(checkpoint["scaler_state_dict"])
+
+    # Model files saved before the RNG state was added resume with the current state
+    rng_state = checkpoint.get("rng_state")
+    if rng_state:
+        torch.set_rng_state(rng_state["torch"])
+        if rng_state["cuda"] and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng_state["cuda"])
+        random.setstate(rng_state["python"])
+        np.random.set_state(rng_state["numpy"])
+
+    return checkpoint
+
+
+def snapshot_to_cpu(obj):
+    """Recursively copies the tensors of a checkpoint to CPU so training can keep updating the originals."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((key, snapshot_to_cpu(value)) for key, value in obj.items())
+        if hasattr(obj, "_metadata"):
+            # Version info of the module state dicts
+            snapshot._metadata = obj._metadata
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter():
+    """Saves model files like save_model, serializing them on a background thread.
+
+    save only snapshots the state to CPU memory, the torch.save call and the removal of old
+    checkpoints happen off the training thread. A save blocks only while the previous
+    checkpoint is still being written. With keep_last, only the newest keep_last
+    checkpoints written by this writer are kept.
+    """
+
+    def __init__(self, models_folder_path, keep_last=None):
+        self.models_folder_path = models_folder_path
+        self.keep_last = keep_last
+        self.saved_paths = []
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._write_checkpoints, daemon=True)
+        self.thread.start()
+
+    def save(self, encoder, decoder, optimizer, epoch, loss, batch_size, vocab, max_sentence_length=None,
+             scaler=None):
+        self._raise_error()
+        if not is_main_process():
+            return None
+
+        path = model_path(self.models_folder_path, epoch, loss, batch_size)
+        checkpoint = snapshot_to_cpu(
+            model_checkpoint(encoder, decoder, optimizer, epoch, loss, vocab, max_sentence_length, scaler))
+        self.queue.put((path, checkpoint))
+
+        return path
+
+    def close(self):
+        """Waits for the pending checkpoints to be written."""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
+
+    def _write_checkpoints(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            path, checkpoint = item
+            try:
+                # Written under a temporary name so a preempted save never leaves a truncated model file
+                tmp_path = path.with_suffix(".pth.tmp")
+                torch.save(checkpoint, tmp_path)
+                tmp_path.replace(path)
+
+                if path not in self.saved_paths:
+                    self.saved_paths.append(path)
+                while self.keep_last and len(self.saved_paths) > self.keep_last:
+                    old_path = self.saved_paths.pop(0)
+                    if old_path.exists():
+                        old_path.unlink()
+            except Exception as e:
+                self.error = e
 
-    torch.save({'epoch': epoch,
-                'encoder_model_state_dict': encoder.state_dict(),
-                'decoder_model_state_dict': decoder.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'loss': loss,
-                'vocab': vocab
-                }, MODEL_PATH)
 
 # Util for better model names when saving
 
@@ -90,19 +282,29 @@ def model_name_formated(model_name, stats_dict, delimiter="--"):
 
 
 def ids_to_tokens(vocab, ids):
-    tokens = []
-
-    for id in ids:
-        token = vocab.get_token_by_id(id)
-
-        if token == vocab.get_end_token():
-            break
-        if token == vocab.get_start_token() or token == ',':
-            continue
+    """Converts predicted ids to tokens, stopping at END and skipping START and commas.
 
-        tokens.append(token)
-
-    return tokens
+    Args:
+        ids: 1D sequence of ids, or a 2D (n_sequences, length) matrix of ids.
+    Returns:
+        tokens: list of tokens for 1D input, list of token lists for 2D input.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if ids.ndim == 1:
+        return ids_to_tokens(vocab, ids[np.newaxis])[0]
+    if ids.shape[1] == 0:
+        # argmax has nothing to reduce over
+        return [[] for _ in range(ids.shape[0])]
+
+    tokens = vocab.get_tokens_by_ids(ids)
+
+    # Everything from the first END token on is dropped
+    is_end = tokens == vocab.get_end_token()
+    end_positions = np.where(is_end.any(axis=1), is_end.argmax(axis=1), ids.shape[1])
+    keep = np.arange(ids.shape[1])[np.newaxis] < end_positions[:, np.newaxis]
+    keep &= (tokens != vocab.get_start_token()) & (tokens != ',')
+
+    return [row_tokens[row_keep].tolist() for row_tokens, row_keep in zip(tokens, keep)]
 
 
 def generate_visualization_object(dataset, predictions, targets):
@@ -1,4 +1,5 @@
 import json
+import numpy as np
 
 START_TOKEN = "START"
 END_TOKEN = "END"
@@ -14,6 +15,7 @@ class Vocab():
 
         self.token_to_id = dict()
         self.id_to_token = dict()
+        self._token_table = None
 
         for token in init_tokens:
             self.add_token(token)
@@ -28,6 +30,7 @@ class Vocab():
             curr_length = len(self.token_to_id)
             self.token_to_id[token] = curr_length
             self.id_to_token[curr_length] = token
+            self._token_table = None
 
     def __read_vocab_from_file__(self, vocab_path):
         with open(vocab_path, "r") as reader:
@@ -35,16 +38,31 @@ class Vocab():
             return tokens
 
     def get_token_by_id(self, id):
-        if not id in self.id_to_token:
-            return self.id_to_token[self.token_to_id[UNKOWN_TOKEN]]
-        else:
-            return self.id_to_token[id]
+        return self.id_to_token.get(id, UNKOWN_TOKEN)
 
     def get_id_by_token(self, token):
-        if not token in self.token_to_id:
-            return self.token_to_id[UNKOWN_TOKEN]
-        else:
-            return self.token_to_id[token]
+        return self.token_to_id.get(token, self.token_to_id[UNKOWN_TOKEN])
+
+    def get_ids_by_tokens(self, tokens):
+        """Maps a list of tokens to an int64 array of ids, unknown tokens map to UNKNOWN."""
+        unknown_id = self.token_to_id[UNKOWN_TOKEN]
+        return np.fromiter((self.token_to_id.get(token, unknown_id) for token in tokens),
+                           dtype=np.int64, count=len(tokens))
+
+    def get_tokens_by_ids(self, ids):
+        """Maps an array of ids of any shape to an object array of tokens with the same shape."""
+        ids = np.asarray(ids, dtype=np.int64)
+        token_table = self.get_token_table()
+        # Ids out of range map to the extra UNKNOWN entry at the end of the table
+        ids = np.where((ids >= 0) & (ids < len(self)), ids, len(self))
+        return token_table[ids]
+
+    def get_token_table(self):
+        # Built lazily, so vocabs unpickled from older model files get it as well
+        if getattr(self, "_token_table", None) is None:
+            self._token_table = np.array(
+                [self.id_to_token[id] for id in range(len(self))] + [UNKOWN_TOKEN], dtype=object)
+        return self._token_table
 
     def get_start_token(self):
         return START_TOKEN
@@ -2,38 +2,38 @@ import argparse
 import os
 import json
 from tqdm import tqdm
-from tree_distance import calculate_ted, extract_html_tree
+from tree_distance import calculate_document_ted, calculate_bounded_ted, extract_html_tree
+from html_document import HtmlDocument, default_parser
 from skimage.metrics import structural_similarity as ssim
-import cv2
+from fast_ssim import load_gray_pair, ssim_index
+from metrics_store import METRICS, MetricsStore, RunningMeans, file_hash, inputs_hash
+from metric_scheduler import MetricTask, schedule
 from matplotlib.figure import Figure
 import numpy as np
 from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
-from nltk import edit_distance
-from bs4 import BeautifulSoup
+from html_bleu import tokenize_html, bleu_stats, bleu_from_stats
+from char_edit_distance import edit_distance, BACKENDS
 from zss import Node
 
 import multiprocessing
 from itertools import product
+from collections import Counter
 
 import time
 
 def remove_texts(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
-        
-    for text_node in soup.find_all(text=True):
-        text_node.replace_with(" ")
-    return str(soup)
+    return HtmlDocument(html_content, 'html.parser').text_stripped
 
 
-def calculate_ssim_index(folder, imageA_path, imageB_path, index_sample):
-    imageA = cv2.imread(imageA_path)
-    imageB = cv2.imread(imageB_path)
+def calculate_ssim_index(imageA_path, imageB_path, scale=1.0):
+    # Only the scalar, the maps are drawn by save_ssim_figures when they are asked for
+    return ssim_index(*load_gray_pair(imageA_path, imageB_path, scale))
 
-    imageB = cv2.resize(imageB, (imageA.shape[1], imageA.shape[0]))
 
-    imageA_gray = cv2.cvtColor(imageA, cv2.COLOR_BGR2GRAY)
-    imageB_gray = cv2.cvtColor(imageB, cv2.COLOR_BGR2GRAY)
+def save_ssim_figures(args):
+    folder, imageA_path, imageB_path, index_sample = args
 
+    imageA_gray, imageB_gray = load_gray_pair(imageA_path, imageB_path)
     ssim_index, gradient, ssim_map = ssim(imageA_gray, imageB_gray, full=True, gradient=True)
 
 
@@ -54,15 +54,23 @@ def calculate_ssim_index(folder, imageA_path, imageB_path, index_sample):
     fig_gradient.colorbar(ax_gradient.imshow(gradient_magnitude, cmap="Blues"), ax=ax_gradient)
     fig_gradient.savefig(f"{folder}{index_sample}_gradient_map.png")
 
-    return ssim_index
 
+def screenshot_paths(folder, json_file, pix2codeOriginal, webUI2code):
+    if pix2codeOriginal:
+        answer_png_file_path = folder + json_file.replace(".json", "_answer.png")
+        prediction_png_file_path = folder + json_file.replace(".json", "_pred.png")
+    elif webUI2code:
+        answer_png_file_path = folder + json_file.replace(".json", "_answer_separated_processed.png")
+        prediction_png_file_path = folder + json_file.replace(".json", "_pred_separated_processed.png")
+    else:
+        answer_png_file_path = folder + json_file.replace(".json", "_answer_processed.png")
+        prediction_png_file_path = folder + json_file.replace(".json", "_pred_processed.png")
+    return answer_png_file_path, prediction_png_file_path
 
-def calculate_metric(args):
-    json_file, folder, pix2codeOriginal, rico, ui2code, webUI2code = args
-
-    with open(folder + json_file, "r") as fr:
-        json_dict = json.load(fr)
 
+def text_file_paths(folder, json_file, pix2codeOriginal, rico, ui2code, webUI2code):
+    # The processed html files are only used by the html datasets
+    answer_file_path = prediction_file_path = None
     if pix2codeOriginal:
         answer_raw_file_path = folder + json_file.replace(".json", "_answer.gui")
         prediction_raw_file_path = folder + json_file.replace(".json", "_pred.gui")
@@ -79,97 +87,179 @@ def calculate_metric(args):
         prediction_raw_file_path = folder + json_file.replace(".json", "_pred.txt")
         answer_file_path = folder + json_file.replace(".json", "_answer_processed.html")
         prediction_file_path = folder + json_file.replace(".json", "_pred_processed.html")
+    return answer_raw_file_path, prediction_raw_file_path, answer_file_path, prediction_file_path
 
-    with open(prediction_raw_file_path, 'r') as f:
-        pred_raw = f.read()
-
-    with open(answer_raw_file_path, 'r') as f:
-        answer_raw = f.read()
-
-   
-    if pix2codeOriginal or rico or ui2code:
-        pred = pred_raw
-        answer = answer_raw
-    else: 
-        with open(prediction_file_path, 'r') as f:
-            pred = f.read()
-            pred_html = extract_html_tree(pred)
-
-        with open(answer_file_path, 'r') as f:
-            answer = f.read()
-            answer_html = extract_html_tree(answer)
-
-
-    # Normalized Edit Distance
-    ed_score = edit_distance(pred_raw, answer_raw)
-    normalized_ed_score = ed_score / max(len(pred_raw), len(answer_raw))
-    
-    # Bleu Score
-    bleu_score = corpus_bleu([[answer_raw]], [pred_raw], smoothing_function=SmoothingFunction().method4)
 
-    if not pix2codeOriginal and not rico and not ui2code:
+def metric_names(pix2codeOriginal, rico, ui2code):
+    if rico or ui2code:
+        return ["ed", "bleu"]
+    if pix2codeOriginal:
+        return ["ed", "bleu", "ssim_index"]
+    return ["ed", "bleu", "ted", "s_bleu", "html_bleu", "ssim_index"]
+
+
+# Keys every metric writes in the json file of a sample, besides its timeout flag
+METRIC_FIELDS = {
+    "ed": ["len_pred", "len_answer", "max_len", "ed", "n_ed", "ed_above", "ed_lower_bound"],
+    "bleu": ["bleu"],
+    "ted": ["html_parser", "ted", "n_ted", "ted_approximate", "ted_bounds"],
+    "s_bleu": ["s_bleu"],
+    "html_bleu": ["html_bleu", "s_html_bleu", "html_bleu_stats", "s_html_bleu_stats"],
+    "ssim_index": ["ssim_index"],
+}
+
+
+def write_sample_json(json_path, fields, metrics):
+    """
+    Writes the results of a sample in its json file.
+
+    The keys of the given metrics are removed first, so values left by earlier runs
+    (an exact ted next to old bounds, a value before a timeout) do not survive.
+    Keys of other metrics and of the postprocessing are kept.
+    """
+    with open(json_path, "r") as fr:
+        json_dict = json.load(fr)
+    for metric in metrics:
+        for key in METRIC_FIELDS[metric] + [f"{metric}_timeout"]:
+            json_dict.pop(key, None)
+    json_dict.update(fields)
+    with open(json_path, "w") as fw:
+        json.dump(json_dict, fw, indent=2)
+
+
+def metric_input_paths(metric, folder, json_file, pix2codeOriginal, rico, ui2code, webUI2code):
+    # Answer files first, then prediction files
+    answer_raw_file_path, prediction_raw_file_path, answer_file_path, prediction_file_path = text_file_paths(
+        folder, json_file, pix2codeOriginal, rico, ui2code, webUI2code)
+    if metric == "ted":
+        return [answer_file_path, prediction_file_path]
+    if metric == "ssim_index":
+        return list(screenshot_paths(folder, json_file, pix2codeOriginal, webUI2code))
+    if metric == "ed" and answer_file_path:
+        # The lengths stored with the edit distance are the ones of the processed files
+        return [answer_raw_file_path, prediction_raw_file_path, answer_file_path, prediction_file_path]
+    return [answer_raw_file_path, prediction_raw_file_path]
+
+
+def metric_settings(metric, args):
+    if metric == "ted":
+        return (args.html_parser or default_parser(), args.ted_max_nodes, args.ted_time_budget)
+    if metric == "s_bleu":
+        return (args.html_parser or default_parser(),)
+    if metric == "ssim_index":
+        return (args.ssim_scale,)
+    if metric == "ed":
+        return (args.ed_max_normalized, args.ed_backend)
+    return ()
+
+
+def estimate_cost(metric, paths):
+    # Rough seconds from the input sizes, only used to order and group the tasks
+    answer_size, pred_size = [os.path.getsize(path) if os.path.exists(path) else 0 for path in paths[:2]]
+    if metric == "ed":
+        return answer_size * pred_size * 1e-9
+    if metric == "ted":
+        return answer_size * pred_size * 1e-10
+    if metric == "ssim_index":
+        return (answer_size + pred_size) * 2e-8
+    return (answer_size + pred_size) * 1e-6
+
+
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def calculate_metric(task):
+    """
+    Computes one metric of one sample.
+
+    Returns:
+    float: The value averaged over the samples, None when it is not available.
+    dict: The fields written in the json file of the sample.
+    """
+    metric, paths, settings = task.metric, task.paths, task.settings
+
+    if metric == "ssim_index":
+        # Structural visual similarity
+        answer_png_file_path, prediction_png_file_path = paths
+        if not os.path.exists(answer_png_file_path) or not os.path.exists(prediction_png_file_path):
+            return None, {}
+        ssim_value = calculate_ssim_index(answer_png_file_path, prediction_png_file_path, settings[0])
+        return ssim_value, {"ssim_index": ssim_value} if ssim_value else {}
 
+    if metric == "ted":
         # HTML Tree edit distance
-        ted, normalized_ted = calculate_ted(answer_html, pred_html)
-
+        html_parser, ted_max_nodes, ted_time_budget = settings
+        answer_document = HtmlDocument(extract_html_tree(read_file(paths[0])), html_parser)
+        pred_document = HtmlDocument(extract_html_tree(read_file(paths[1])), html_parser)
+
+        fields = {"html_parser": answer_document.parser}
+        if ted_max_nodes is not None or ted_time_budget is not None:
+            ted, normalized_ted, ted_approximate, ted_bounds = calculate_bounded_ted(
+                answer_document, pred_document, max_nodes=ted_max_nodes, time_budget=ted_time_budget)
+            if ted_approximate:
+                fields["ted_bounds"] = ted_bounds
+        else:
+            ted, normalized_ted = calculate_document_ted(answer_document, pred_document)
+            ted_approximate = False
+        fields.update({"ted": ted, "n_ted": normalized_ted, "ted_approximate": ted_approximate})
+        return ted, fields
+
+    answer_raw = read_file(paths[0])
+    pred_raw = read_file(paths[1])
+
+    if metric == "ed":
+        # Normalized Edit Distance
+        ed_max_normalized, ed_backend = settings
+        max_len_raw = max(len(pred_raw), len(answer_raw))
+        max_distance = int(ed_max_normalized * max_len_raw) if ed_max_normalized is not None else None
+        ed_score = edit_distance(pred_raw, answer_raw, ed_backend, max_distance)
+        normalized_ed_score = ed_score / max_len_raw if ed_score is not None else None
+
+        answer, pred = (read_file(paths[2]), read_file(paths[3])) if len(paths) == 4 else (answer_raw, pred_raw)
+        fields = {"len_pred": len(pred), "len_answer": len(answer), "max_len": max(len(pred), len(answer)),
+                  "ed": ed_score, "n_ed": normalized_ed_score}
+        if ed_score is None:
+            # Only known to be above the bound, the average counts the sample at its lowest possible distance
+            fields.update({"ed_above": ed_max_normalized, "ed_lower_bound": max_distance + 1})
+            return max_distance + 1, fields
+        return ed_score, fields
+
+    if metric == "bleu":
+        # Bleu Score
+        bleu_score = corpus_bleu([[answer_raw]], [pred_raw], smoothing_function=SmoothingFunction().method4)
+        return bleu_score, {"bleu": bleu_score}
+
+    if metric == "s_bleu":
         # Structural Bleu Score
-        answer_no_texts = remove_texts(answer_raw)
-        pred_no_texts = remove_texts(pred_raw)
+        answer_no_texts = HtmlDocument(answer_raw, settings[0]).text_stripped
+        pred_no_texts = HtmlDocument(pred_raw, settings[0]).text_stripped
         str_bleu_score = corpus_bleu([[answer_no_texts]], [pred_no_texts], smoothing_function=SmoothingFunction().method4)
+        return str_bleu_score, {"s_bleu": str_bleu_score}
+
+    if metric == "html_bleu":
+        # Bleu Scores over tag, attribute and text tokens, the statistics give the corpus scores
+        answer_tokens, answer_structure = tokenize_html(answer_raw)
+        pred_tokens, pred_structure = tokenize_html(pred_raw)
+        stats = bleu_stats(answer_tokens, pred_tokens)
+        structure_stats = bleu_stats(answer_structure, pred_structure)
+        html_bleu_score = bleu_from_stats([stats])
+        return html_bleu_score, {"html_bleu": html_bleu_score, "s_html_bleu": bleu_from_stats([structure_stats]),
+                                 "html_bleu_stats": stats, "s_html_bleu_stats": structure_stats}
+
+    raise ValueError(f"Unknown metric {metric}")
+
+
+def parse_metric_workers(values):
+    metric_workers = dict()
+    for value in values:
+        metric, workers = value.split("=")
+        if metric not in METRICS or int(workers) < 1:
+            raise ValueError(f"Invalid worker cap {value}")
+        metric_workers[metric] = int(workers)
+    return metric_workers
 
-        # Structural visual similarity
-        if webUI2code:
-            answer_png_file_path = folder + json_file.replace(".json", "_answer_separated_processed.png")
-            prediction_png_file_path = folder + json_file.replace(".json", "_pred_separated_processed.png")
-        else:
-            answer_png_file_path = folder + json_file.replace(".json", "_answer_processed.png")
-            prediction_png_file_path = folder + json_file.replace(".json", "_pred_processed.png")
-
-        if os.path.exists(answer_png_file_path) and os.path.exists(prediction_png_file_path):
-            ssim_index = calculate_ssim_index(folder, answer_png_file_path, prediction_png_file_path, json_file.split(".")[0])
-        else:
-            ssim_index = None
- 
-    elif pix2codeOriginal:
-        # Structural visual similarity
-        answer_png_file_path = folder + json_file.replace(".json", "_answer.png")
-        prediction_png_file_path = folder + json_file.replace(".json", "_pred.png")
-
-        if os.path.exists(answer_png_file_path) and os.path.exists(prediction_png_file_path):
-            ssim_index = calculate_ssim_index(folder, answer_png_file_path, prediction_png_file_path, json_file.split(".")[0])
-        else:
-            ssim_index = None
-
-        str_bleu_score = -1
-        ted = -1
-        normalized_ted = -1
-
-    elif rico or ui2code:
-        str_bleu_score = -1
-        ted = -1
-        normalized_ted = -1
-        ssim_index = -1
-
-
-    json_dict["len_pred"] = len(pred) 
-    json_dict["len_answer"] = len(answer) 
-    json_dict["max_len"] = max(len(pred), len(answer))
-    json_dict["bleu"] = bleu_score
-    json_dict["ed"] = ed_score 
-    json_dict["n_ed"] = normalized_ed_score
-    if not rico and not ui2code:
-        if ssim_index:
-            json_dict["ssim_index"] = ssim_index 
-
-    if not pix2codeOriginal and not rico and not ui2code:
-        json_dict["s_bleu"] = str_bleu_score
-        json_dict["ted"] = ted
-        json_dict["n_ted"] = normalized_ted
-
-    with open(folder + json_file, "w") as fw:
-        json.dump(json_dict, fw, indent=2)      
-    
-    return ted, ssim_index, ed_score, bleu_score, str_bleu_score
     
 if __name__ == "__main__":
     folder = "results/demo"
@@ -192,6 +282,47 @@ if __name__ == "__main__":
     parser.add_argument("--webUI2code", action='store_true',
                         help="Specifies if it is the ui2code dataset")
 
+    parser.add_argument("--html_parser", choices=["lxml", "html.parser"], default=None,
+                        help="HTML parser of the tree and structural metrics, defaults to lxml when it is installed. "
+                             "Use html.parser to compare with results computed before lxml was supported")
+
+    parser.add_argument("--ted_max_nodes", type=int, default=None,
+                        help="Documents with more nodes get an approximate tree edit distance, flagged in their json file")
+
+    parser.add_argument("--ted_time_budget", type=float, default=None,
+                        help="Seconds after which the tree edit distance of a sample falls back to an approximation")
+
+    parser.add_argument("--ed_backend", choices=BACKENDS, default="auto",
+                        help="Edit distance implementation, they all give the same values as nltk.edit_distance")
+
+    parser.add_argument("--ed_max_normalized", type=float, default=None,
+                        help="Stop the edit distance of a sample once its normalized value is above this bound, "
+                             "such samples are flagged in their json file and counted at their lower bound in the average")
+
+    parser.add_argument("--ssim_scale", type=float, default=1.0,
+                        help="Downscale factor of the screenshots before the SSIM index, 1.0 keeps the full resolution")
+
+    parser.add_argument("--ssim_figures", action='store_true',
+                        help="Also draw the SSIM and gradient maps of every sample, in a separate step")
+
+    parser.add_argument("--store", default=None,
+                        help="SQLite file keeping the results of the run, defaults to metrics.sqlite in the folder. "
+                             "Samples whose files and settings did not change are not computed again")
+
+    parser.add_argument("--recompute", action='store_true',
+                        help="Compute every sample again, even the ones already in the store")
+
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes")
+
+    parser.add_argument("--metric_workers", nargs="*", default=[],
+                        help="Maximum number of workers running a metric at the same time, as metric=count, "
+                             "for example ted=4 ssim_index=2")
+
+    parser.add_argument("--task_timeout", type=float, default=None,
+                        help="Seconds after which a metric of a sample is abandoned, it is flagged in the json file "
+                             "and computed again on the next run")
+
     # Read args
     args = parser.parse_args()
 
@@ -203,37 +334,108 @@ if __name__ == "__main__":
     if args.rico or args.ui2code:
         files = [file for file in os.listdir(folder) if file.endswith('_pred.txt')]
         for filename in files:
+            json_path = os.path.join(folder, filename.split("_pred.txt")[0] + ".json")
+            # Kept when it exists, it holds the stored results of a previous run
+            if os.path.exists(json_path):
+                continue
             dict_tmp = {}
-            with open(os.path.join(folder, filename.split("_pred.txt")[0] + ".json"), "w") as f:
+            with open(json_path, "w") as f:
                 json.dump(dict_tmp, f, indent=2)
 
     json_files= [file for file in os.listdir(folder) if file.endswith('.json') if not file.endswith("_answer.json")]
     print(f"Number of files: {len(json_files)}")
     start = time.time()
-    pool_size = multiprocessing.cpu_count()
-
-    with multiprocessing.Pool(processes=pool_size) as pool:
-        results = []
-        for result in tqdm(pool.imap_unordered(func=calculate_metric, iterable=[(filename, folder, args.pix2codeOriginal, args.rico, args.ui2code, args.webUI2code) for filename in json_files]), total=len(json_files)):
-            results.append(result)
-
-    teds, ssims, eds, bleus, s_bleus = zip(*results)
-
-
-    avg_ed = np.mean(eds)
-    print(f"   Avg Edit Distance = {avg_ed:.3f}")
+    pool_size = args.workers
+    metrics = metric_names(args.pix2codeOriginal, args.rico, args.ui2code)
+
+    inputs = {(json_file, metric): metric_input_paths(metric, folder, json_file, args.pix2codeOriginal, args.rico,
+                                                      args.ui2code, args.webUI2code)
+              for json_file in json_files for metric in metrics}
+
+    store = MetricsStore(args.store or folder + "metrics.sqlite")
+    try:
+        stored_hashes = dict() if args.recompute else store.hashes()
+        means = RunningMeans()
+        sample_fields = {json_file: dict() for json_file in json_files}
+        remaining = Counter()
+
+        with multiprocessing.Pool(processes=pool_size) as pool:
+            all_paths = sorted({path for paths in inputs.values() for path in paths})
+            file_hashes = dict(pool.imap_unordered(file_hash, all_paths, chunksize=64))
+
+            # Metrics whose files and settings did not change since they were stored are skipped
+            tasks = []
+            for (json_file, metric), paths in inputs.items():
+                settings = metric_settings(metric, args)
+                metric_hash = inputs_hash(metric, [file_hashes[path] for path in paths], settings)
+                if stored_hashes.get((json_file, metric)) == metric_hash:
+                    value, fields = store.get(json_file, metric)
+                    means.add(metric, value)
+                    sample_fields[json_file].update(fields)
+                else:
+                    tasks.append(MetricTask(json_file, metric, paths, settings, metric_hash, estimate_cost(metric, paths)))
+                    remaining[json_file] += 1
+            print(f"Skipped {len(inputs) - len(tasks)} unchanged metrics")
+
+            # Samples without anything to compute get their stored results back, their json file may have been rewritten
+            for json_file in json_files:
+                if remaining[json_file] == 0:
+                    write_sample_json(folder + json_file, sample_fields[json_file], metrics)
+
+            progress = tqdm(total=len(tasks))
+            for task, value, fields, timed_out in schedule(pool, calculate_metric, tasks, pool_size,
+                                                           parse_metric_workers(args.metric_workers), args.task_timeout):
+                # Timed out metrics are not stored, so they are computed again on the next run
+                if timed_out:
+                    store.delete(task.sample, task.metric)
+                else:
+                    store.put(task.sample, task.metric, task.inputs_hash, value, fields)
+                    means.add(task.metric, value)
+                sample_fields[task.sample].update(fields)
+
+                remaining[task.sample] -= 1
+                if remaining[task.sample] == 0:
+                    write_sample_json(folder + task.sample, sample_fields[task.sample], metrics)
+
+                progress.update()
+                progress.set_postfix(ed=means.mean("ed"), bleu=means.mean("bleu"))
+            progress.close()
+
+            if args.ssim_figures and not args.rico and not args.ui2code:
+                figure_tasks = []
+                for filename in json_files:
+                    answer_png_file_path, prediction_png_file_path = screenshot_paths(folder, filename, args.pix2codeOriginal, args.webUI2code)
+                    if os.path.exists(answer_png_file_path) and os.path.exists(prediction_png_file_path):
+                        figure_tasks.append((folder, answer_png_file_path, prediction_png_file_path, filename.split(".")[0]))
+                for _ in tqdm(pool.imap_unordered(func=save_ssim_figures, iterable=figure_tasks), total=len(figure_tasks)):
+                    pass
+    finally:
+        # Also on errors and interrupts, so the results computed so far are committed
+        store.close()
+
+    avg_ed = means.mean("ed")
+    n_ed_above = sum("ed_above" in fields for fields in sample_fields.values())
+    if n_ed_above:
+        print(f"   Avg Edit Distance >= {avg_ed:.3f} ({n_ed_above} samples above --ed_max_normalized at their lower bound)")
+    else:
+        print(f"   Avg Edit Distance = {avg_ed:.3f}")
 
-    avg_bleu = np.mean(bleus)
+    avg_bleu = means.mean("bleu")
     print(f"             Avg Bleu Score = {avg_bleu:.3f}")
 
-    if not args.pix2codeOriginal and not args.rico:
-        avg_ted = np.mean(teds)
-        avg_s_bleu = np.mean(s_bleus)
+    if not args.pix2codeOriginal and not args.rico and not args.ui2code:
+        avg_ted = means.mean("ted")
+        avg_s_bleu = means.mean("s_bleu")
         print(f"Avg HTML Tree Edit Distance = {avg_ted:.3f}")
 
+        # Corpus scores, from the statistics of all the samples instead of the mean of their scores
+        html_bleu_stats = [fields["html_bleu_stats"] for fields in sample_fields.values() if "html_bleu_stats" in fields]
+        s_html_bleu_stats = [fields["s_html_bleu_stats"] for fields in sample_fields.values() if "s_html_bleu_stats" in fields]
+        print(f"     Corpus HTML Bleu Score = {bleu_from_stats(html_bleu_stats):.3f}")
+        print(f"Corpus Structural HTML Bleu = {bleu_from_stats(s_html_bleu_stats):.3f}")
+
     if not args.rico and not args.ui2code:
-        filtered_ssims = [x for x in ssims if x is not None]
-        avg_ssim_index = np.mean(filtered_ssims)
+        avg_ssim_index = means.mean("ssim_index")
         print(f"             Avg SSIM index = {avg_ssim_index:.3f}")
     
     print(f"/nExecution time: {time.time() - start}")
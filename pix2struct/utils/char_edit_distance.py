@@ -0,0 +1,122 @@
+import numpy as np
+
+try:
+    from rapidfuzz.distance import Levenshtein as rapidfuzz_levenshtein
+except ImportError:
+    rapidfuzz_levenshtein = None
+
+BACKENDS = ["auto", "rapidfuzz", "bitparallel", "numpy"]
+
+
+def bit_parallel_distance(s1, s2, max_distance=None):
+    """
+    Levenshtein distance with the bit-parallel algorithm of Myers, in the formulation of Hyyrö.
+
+    The column of the dynamic programming table is kept as bit vectors of vertical deltas,
+    stored in Python integers, so every character of the longer string costs a few big
+    integer operations over the shorter one.
+
+    Parameters:
+    s1, s2 (str): The strings to be compared.
+    max_distance (int): Stops as soon as the distance is known to be bigger, None to always compute it.
+
+    Returns:
+    int: The distance, None when it is bigger than max_distance.
+    """
+    pattern, text = (s1, s2) if len(s1) <= len(s2) else (s2, s1)
+    if max_distance is not None and len(text) - len(pattern) > max_distance:
+        return None
+    if not pattern:
+        return len(text)
+
+    # Bit i of the mask of a character is set when pattern[i] is that character
+    masks = dict()
+    for i, character in enumerate(pattern):
+        masks[character] = masks.get(character, 0) | (1 << i)
+
+    all_bits = (1 << len(pattern)) - 1
+    last_bit = 1 << (len(pattern) - 1)
+    vp, vn = all_bits, 0
+    distance = len(pattern)
+
+    for j, character in enumerate(text):
+        eq = masks.get(character, 0)
+        xv = eq | vn
+        xh = (((eq & vp) + vp) ^ vp) | eq
+        hp = vn | (~(xh | vp) & all_bits)
+        hn = vp & xh
+
+        if hp & last_bit:
+            distance += 1
+        elif hn & last_bit:
+            distance -= 1
+
+        # The first row of the table grows by one at every column
+        hp = ((hp << 1) | 1) & all_bits
+        hn = (hn << 1) & all_bits
+        vp = hn | (~(xv | hp) & all_bits)
+        vn = hp & xv
+
+        # Every remaining character lowers the distance by one at most
+        if max_distance is not None and distance - (len(text) - j - 1) > max_distance:
+            return None
+
+    return distance
+
+
+def numpy_distance(s1, s2, max_distance=None):
+    """
+    Levenshtein distance with the dynamic programming table filled one vectorized row at a time.
+
+    Insertions along a row are a cumulative minimum, so every row costs a few numpy operations.
+
+    Parameters:
+    s1, s2 (str): The strings to be compared.
+    max_distance (int): Stops as soon as the distance is known to be bigger, None to always compute it.
+
+    Returns:
+    int: The distance, None when it is bigger than max_distance.
+    """
+    rows, columns = (s1, s2) if len(s1) >= len(s2) else (s2, s1)
+    if max_distance is not None and len(rows) - len(columns) > max_distance:
+        return None
+
+    columns = np.array([ord(character) for character in columns], dtype=np.int64)
+    positions = np.arange(len(columns) + 1)
+    row = positions.copy()
+    for i, character in enumerate(rows, 1):
+        best = row + 1
+        best[1:] = np.minimum(best[1:], row[:-1] + (columns != ord(character)))
+        best[0] = i
+        row = np.minimum.accumulate(best - positions) + positions
+        # The smallest value of a row never decreases on the next rows
+        if max_distance is not None and row.min() > max_distance:
+            return None
+    distance = int(row[-1])
+    return None if max_distance is not None and distance > max_distance else distance
+
+
+def edit_distance(s1, s2, backend="auto", max_distance=None):
+    """
+    Character level Levenshtein distance, the same value as nltk.edit_distance with its default costs.
+
+    Parameters:
+    s1, s2 (str): The strings to be compared.
+    backend (str): "rapidfuzz" when it is installed, "bitparallel" or "numpy". "auto" picks rapidfuzz when
+                   it is installed and the bit-parallel algorithm otherwise.
+    max_distance (int): Stops as soon as the distance is known to be bigger, None to always compute it.
+
+    Returns:
+    int: The distance, None when it is bigger than max_distance.
+    """
+    if backend == "auto":
+        backend = "rapidfuzz" if rapidfuzz_levenshtein is not None else "bitparallel"
+
+    if backend == "rapidfuzz":
+        distance = rapidfuzz_levenshtein.distance(s1, s2, score_cutoff=max_distance)
+        return None if max_distance is not None and distance > max_distance else distance
+    if backend == "bitparallel":
+        return bit_parallel_distance(s1, s2, max_distance)
+    if backend == "numpy":
+        return numpy_distance(s1, s2, max_distance)
+    raise ValueError(f"Unknown edit distance backend {backend}")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of this folder import each other by name, as when the scripts are run from here
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
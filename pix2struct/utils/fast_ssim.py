@@ -0,0 +1,73 @@
+import cv2
+import numpy as np
+
+# Same constants as skimage.metrics.structural_similarity with its defaults on uint8 images
+WIN_SIZE = 7
+DATA_RANGE = 255
+K1 = 0.01
+K2 = 0.03
+
+
+def load_gray_pair(imageA_path, imageB_path, scale=1.0):
+    """
+    Reads two screenshots as grayscale images of the same size, as calculate_ssim_index does.
+
+    Parameters:
+    imageA_path, imageB_path (str): The screenshots, the second one is resized to the size of the first.
+    scale (float): Downscale factor applied to both images, 1.0 keeps the full resolution.
+
+    Returns:
+    np.ndarray, np.ndarray: The grayscale uint8 images.
+    """
+    imageA = cv2.imread(imageA_path)
+    imageB = cv2.imread(imageB_path)
+
+    imageB = cv2.resize(imageB, (imageA.shape[1], imageA.shape[0]))
+
+    imageA_gray = cv2.cvtColor(imageA, cv2.COLOR_BGR2GRAY)
+    imageB_gray = cv2.cvtColor(imageB, cv2.COLOR_BGR2GRAY)
+
+    if scale != 1.0:
+        # The SSIM window needs at least WIN_SIZE pixels on each side
+        height, width = imageA_gray.shape
+        scale = max(scale, WIN_SIZE / min(height, width))
+        size = (max(round(width * scale), WIN_SIZE), max(round(height * scale), WIN_SIZE))
+        imageA_gray = cv2.resize(imageA_gray, size, interpolation=cv2.INTER_AREA)
+        imageB_gray = cv2.resize(imageB_gray, size, interpolation=cv2.INTER_AREA)
+
+    return imageA_gray, imageB_gray
+
+
+def _window_means(image):
+    # Means of every full WIN_SIZE x WIN_SIZE window, the partial windows at the borders are cropped
+    pad = WIN_SIZE // 2
+    return cv2.boxFilter(image, cv2.CV_64F, (WIN_SIZE, WIN_SIZE))[pad:-pad, pad:-pad]
+
+
+def ssim_index(imageA, imageB):
+    """
+    Mean structural similarity of two same sized grayscale images.
+
+    Matches skimage.metrics.structural_similarity with its default parameters: uniform 7x7
+    windows, sample covariances, and the mean taken over the windows inside the image.
+    Only the scalar is computed, without the SSIM map gradient.
+
+    Parameters:
+    imageA, imageB (np.ndarray): uint8 arrays of shape (H, W).
+
+    Returns:
+    float: The SSIM index.
+    """
+    x = np.asarray(imageA, dtype=np.float64)
+    y = np.asarray(imageB, dtype=np.float64)
+
+    ux, uy = _window_means(x), _window_means(y)
+    cov_norm = WIN_SIZE ** 2 / (WIN_SIZE ** 2 - 1)
+    vx = cov_norm * (_window_means(x * x) - ux * ux)
+    vy = cov_norm * (_window_means(y * y) - uy * uy)
+    vxy = cov_norm * (_window_means(x * y) - ux * uy)
+
+    C1 = (K1 * DATA_RANGE) ** 2
+    C2 = (K2 * DATA_RANGE) ** 2
+    S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux ** 2 + uy ** 2 + C1) * (vx + vy + C2))
+    return float(S.mean())
@@ -0,0 +1,113 @@
+import math
+from collections import Counter
+from html.parser import HTMLParser
+
+MAX_ORDER = 4
+
+# Same value as nltk SmoothingFunction().method1
+EPSILON = 0.1
+
+
+class HtmlTokenizer(HTMLParser):
+    """
+    Splits an HTML document in tag, attribute and text tokens.
+
+    A start tag gives "<tag" followed by one "name=value" token per attribute, an end tag gives "</tag>",
+    and texts give one token per word. Comments are left out.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tokens = []
+        self.is_text = []
+
+    def _add(self, token, is_text=False):
+        self.tokens.append(token)
+        self.is_text.append(is_text)
+
+    def handle_starttag(self, tag, attrs):
+        self._add("<" + tag)
+        for name, value in attrs:
+            self._add(name if value is None else f"{name}={' '.join(value.split())}")
+
+    def handle_endtag(self, tag):
+        self._add(f"</{tag}>")
+
+    def handle_decl(self, decl):
+        words = decl.split()
+        self._add("<!" + (words[0].lower() if words else ""))
+
+    def handle_data(self, data):
+        for word in data.split():
+            self._add(word, True)
+
+
+def tokenize_html(html):
+    """
+    Tokenizes an HTML document once for the full and the structural BLEU scores.
+
+    Returns:
+    list: Every token of the document.
+    list: The tag and attribute tokens only.
+    """
+    tokenizer = HtmlTokenizer()
+    tokenizer.feed(html)
+    tokenizer.close()
+    structural = [token for token, is_text in zip(tokenizer.tokens, tokenizer.is_text) if not is_text]
+    return tokenizer.tokens, structural
+
+
+def ngram_counts(tokens, order):
+    return Counter(zip(*[tokens[i:] for i in range(order)]))
+
+
+def bleu_stats(reference, hypothesis, max_order=MAX_ORDER):
+    """
+    Sufficient statistics of the BLEU score of one sample, summed over the samples to get the corpus score.
+
+    Parameters:
+    reference (list): The tokens of the answer.
+    hypothesis (list): The tokens of the prediction.
+    max_order (int): Longest n-grams.
+
+    Returns:
+    list: The clipped n-gram matches and the n-gram counts of every order, then the hypothesis and reference lengths.
+    """
+    matches, totals = [], []
+    for order in range(1, max_order + 1):
+        hypothesis_counts = ngram_counts(hypothesis, order)
+        matches.append(sum((hypothesis_counts & ngram_counts(reference, order)).values()))
+        # As nltk, a sample without n-grams of an order still counts one
+        totals.append(max(1, sum(hypothesis_counts.values())))
+    return matches + totals + [len(hypothesis), len(reference)]
+
+
+def bleu_from_stats(stats, max_order=MAX_ORDER):
+    """
+    Corpus BLEU score from the statistics of its samples.
+
+    Gives the same value as nltk corpus_bleu with uniform weights and SmoothingFunction().method1
+    on the tokens, without keeping the tokens around.
+
+    Parameters:
+    stats (list): The bleu_stats of every sample.
+
+    Returns:
+    float: The BLEU score, 0 when nothing matches.
+    """
+    if not stats:
+        return 0.0
+    sums = [sum(column) for column in zip(*stats)]
+    matches, totals = sums[:max_order], sums[max_order:2 * max_order]
+    hypothesis_length, reference_length = sums[2 * max_order:]
+
+    if matches[0] == 0:
+        return 0.0
+
+    if hypothesis_length > reference_length:
+        brevity_penalty = 1.0
+    else:
+        brevity_penalty = math.exp(1 - reference_length / hypothesis_length)
+
+    log_precisions = [math.log((match if match else EPSILON) / total) for match, total in zip(matches, totals)]
+    return brevity_penalty * math.exp(math.fsum(log_precisions) / max_order)
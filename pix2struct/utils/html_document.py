@@ -0,0 +1,105 @@
+from bs4 import BeautifulSoup
+from ted_engine import encode_tree
+
+try:
+    import lxml.etree
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# Tag names interned to integers, shared by all the documents of the process so their trees can be compared
+TAG_IDS = dict()
+
+
+def default_parser():
+    return "lxml" if lxml is not None else "html.parser"
+
+
+class HtmlDocument():
+    """
+    HTML document parsed once and shared by all the metrics of a sample.
+
+    The "lxml" parser is much faster than "html.parser" but repairs broken markup differently,
+    so tree edit distances and structural BLEU scores are only comparable between runs using the same parser.
+
+    Parameters:
+    html (str): The HTML document in string format.
+    parser (str): "lxml", "html.parser", or None for lxml when it is installed.
+    """
+
+    def __init__(self, html, parser=None):
+        self.parser = parser or default_parser()
+        self._tree = None
+        self._text_stripped = None
+
+        if self.parser == "lxml":
+            try:
+                self._root = self._lxml_parse(html)
+            except lxml.etree.ParserError:
+                # Empty documents
+                self._root = None
+        elif self.parser == "html.parser":
+            self._root = BeautifulSoup(html, 'html.parser')
+        else:
+            raise ValueError(f"Unknown HTML parser {self.parser}")
+
+    @property
+    def tree(self):
+        """PostorderTree of the tags, text nodes are ignored. The root is the document itself, as with BeautifulSoup."""
+        if self._tree is None:
+            if self.parser == "lxml":
+                # None stands for the document, the parent of the root element
+                self._tree = encode_tree(None, self._lxml_children, self._lxml_label, TAG_IDS)
+            else:
+                self._tree = encode_tree(self._root,
+                                         lambda node: [child for child in node.children if child.name],
+                                         lambda node: node.name if node.name else 'root',
+                                         TAG_IDS)
+        return self._tree
+
+    @property
+    def node_count(self):
+        return len(self.tree)
+
+    @property
+    def text_stripped(self):
+        """Serialization of the document with every text node replaced by a space."""
+        if self._text_stripped is None:
+            # Only the texts change, the tag tree stays the same
+            if self.parser == "lxml":
+                self._text_stripped = self._lxml_text_stripped()
+            else:
+                for text_node in self._root.find_all(text=True):
+                    text_node.replace_with(" ")
+                self._text_stripped = str(self._root)
+        return self._text_stripped
+
+    @staticmethod
+    def _lxml_parse(html):
+        try:
+            return lxml.html.document_fromstring(html)
+        except ValueError:
+            # lxml refuses str documents starting with an XML encoding declaration, the bytes are parsed as utf-8
+            return lxml.html.document_fromstring(html.encode("utf-8"), parser=lxml.html.HTMLParser(encoding="utf-8"))
+
+    def _lxml_children(self, node):
+        if node is None:
+            return [self._root] if self._root is not None else []
+        # Comments and processing instructions do not have a string tag
+        return [child for child in node if isinstance(child.tag, str)]
+
+    def _lxml_label(self, node):
+        return '[document]' if node is None else node.tag
+
+    def _lxml_text_stripped(self):
+        if self._root is None:
+            return ""
+        for node in list(self._root.iter()):
+            if not isinstance(node.tag, str) and node.getparent() is not None:
+                node.drop_tree()
+        for node in self._root.iter():
+            if node.text:
+                node.text = " "
+            if node.tail:
+                node.tail = " "
+        return lxml.html.tostring(self._root, encoding="unicode")
@@ -0,0 +1,208 @@
+import re
+import subprocess
+from html.parser import HTMLParser
+
+TIDY_OPTIONS = ["-indent", "-wrap", "0", "--drop-empty-elements", "no"]
+
+# Files given to one tidy process in the batched mode
+TIDY_BATCH_SIZE = 64
+
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "meta", "param",
+                 "source", "track", "wbr", "command", "basefont", "frame", "isindex"}
+
+KNOWN_ELEMENTS = VOID_ELEMENTS | {
+    "a", "abbr", "acronym", "address", "applet", "article", "aside", "audio", "b", "bdi", "bdo", "big", "blink",
+    "blockquote", "body", "button", "canvas", "caption", "center", "cite", "code", "colgroup", "data", "datalist",
+    "dd", "del", "details", "dfn", "dialog", "dir", "div", "dl", "dt", "em", "fieldset", "figcaption", "figure",
+    "font", "footer", "form", "frameset", "h1", "h2", "h3", "h4", "h5", "h6", "head", "header", "hgroup", "html",
+    "i", "iframe", "ins", "kbd", "label", "legend", "li", "main", "map", "mark", "marquee", "menu", "meter", "nav",
+    "noframes", "noscript", "object", "ol", "optgroup", "option", "output", "p", "picture", "pre", "progress", "q",
+    "rp", "rt", "ruby", "s", "samp", "script", "section", "select", "slot", "small", "span", "strike", "strong",
+    "style", "sub", "summary", "sup", "svg", "table", "tbody", "td", "template", "textarea", "tfoot", "th", "thead",
+    "time", "title", "tr", "tt", "u", "ul", "var", "video", "xmp", "math", "path", "g", "circle", "rect", "line",
+    "polygon", "polyline", "ellipse", "defs", "use", "symbol", "text", "tspan", "lineargradient", "stop"}
+
+# End tags that may be left out, as in "<li>a<li>b", tidy accepts them silently
+OPTIONAL_END_TAGS = {"p", "li", "dt", "dd", "td", "th", "tr", "thead", "tbody", "tfoot", "option", "optgroup",
+                     "colgroup", "rp", "rt", "html", "head", "body"}
+
+# Block elements that end an open paragraph
+CLOSES_PARAGRAPH = {"address", "article", "aside", "blockquote", "details", "dialog", "div", "dl", "fieldset",
+                    "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hgroup",
+                    "hr", "main", "menu", "nav", "ol", "p", "pre", "section", "table", "ul"}
+
+# Elements ended by the start of a sibling, searched in the open elements up to the closest container
+IMPLIED_END = {
+    "li": ({"li"}, {"ul", "ol", "menu"}),
+    "dt": ({"dt", "dd"}, {"dl"}),
+    "dd": ({"dt", "dd"}, {"dl"}),
+    "td": ({"td", "th"}, {"tr", "table"}),
+    "th": ({"td", "th"}, {"tr", "table"}),
+    "tr": ({"tr"}, {"table", "thead", "tbody", "tfoot"}),
+    "thead": ({"thead", "tbody", "tfoot"}, {"table"}),
+    "tbody": ({"thead", "tbody", "tfoot"}, {"table"}),
+    "tfoot": ({"thead", "tbody", "tfoot"}, {"table"}),
+    "option": ({"option"}, {"select", "datalist", "optgroup"}),
+    "optgroup": ({"optgroup"}, {"select"}),
+}
+
+# gnu-emacs format of tidy, used to split the messages of a batch by file
+TIDY_EMACS_LINE = re.compile(r"^(.*):(\d+):(\d+): (\w+): (.*)$")
+
+
+class HtmlValidator(HTMLParser):
+    """
+    Checks an HTML document in-process and reports problems with the messages tidy uses.
+
+    Models a subset of the rules of tidy: missing doctype and title, unknown elements, paragraphs
+    ended by a block element, implied ends of list items, table cells and options, stray or missing
+    end tags (optional end tags excepted), attributes without value, repeated attributes and images
+    without alt. test_html_validation compares it with the tidy output recorded for tidy_fixtures by
+    record_tidy_fixtures.py, tidy stays the default validator until those recordings match.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.messages = []
+        self.open_elements = []
+        self.doctype = False
+        self.title = False
+        self.head_position = None
+
+    def _report(self, position, kind, message):
+        self.messages.append((position, kind, message))
+
+    def _position(self):
+        # Tidy columns start at 1
+        line, column = self.getpos()
+        return line, column + 1
+
+    def handle_decl(self, decl):
+        if decl.lower().startswith("doctype"):
+            self.doctype = True
+
+    def _close_implied(self, tag, position):
+        if tag in CLOSES_PARAGRAPH and self.open_elements and self.open_elements[-1] == "p":
+            self.open_elements.pop()
+            if tag != "p":
+                self._report(position, "Warning", f"missing </p> before <{tag}>")
+
+        if tag in IMPLIED_END:
+            siblings, containers = IMPLIED_END[tag]
+            for index in range(len(self.open_elements) - 1, -1, -1):
+                if self.open_elements[index] in containers:
+                    return
+                if self.open_elements[index] in siblings:
+                    for element in self.open_elements[index + 1:]:
+                        if element not in OPTIONAL_END_TAGS:
+                            self._report(position, "Warning", f"missing </{element}> before <{tag}>")
+                    del self.open_elements[index:]
+                    return
+
+    def handle_starttag(self, tag, attrs):
+        position = self._position()
+        self._close_implied(tag, position)
+        if tag not in KNOWN_ELEMENTS:
+            self._report(position, "Error", f"<{tag}> is not recognized!")
+
+        seen = set()
+        for name, value in attrs:
+            if value is None:
+                self._report(position, "Warning", f'<{tag}> attribute "{name}" lacks value')
+            if name in seen:
+                self._report(position, "Warning", f'<{tag}> dropping value "{value}" for repeated attribute "{name}"')
+            seen.add(name)
+        if tag == "img" and "alt" not in seen:
+            self._report(position, "Warning", '<img> lacks "alt" attribute')
+
+        if tag == "title":
+            self.title = True
+        if tag == "head" and self.head_position is None:
+            self.head_position = position
+        if tag not in VOID_ELEMENTS:
+            self.open_elements.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS and self.open_elements and self.open_elements[-1] == tag:
+            self.open_elements.pop()
+
+    def handle_endtag(self, tag):
+        if tag in VOID_ELEMENTS:
+            return
+        position = self._position()
+        if tag not in self.open_elements:
+            self._report(position, "Warning", f"discarding unexpected </{tag}>")
+            return
+        while self.open_elements[-1] != tag:
+            element = self.open_elements.pop()
+            if element not in OPTIONAL_END_TAGS:
+                self._report(position, "Warning", f"missing </{element}> before </{tag}>")
+        self.open_elements.pop()
+
+    def close(self):
+        super().close()
+        position = self._position()
+        while self.open_elements:
+            element = self.open_elements.pop()
+            if element not in OPTIONAL_END_TAGS:
+                self._report(position, "Warning", f"missing </{element}>")
+        if not self.doctype:
+            self._report((1, 1), "Warning", "missing <!DOCTYPE> declaration")
+        if not self.title:
+            self._report(self.head_position or (1, 1), "Warning", "inserting missing 'title' element")
+
+
+def format_messages(messages):
+    # Same lines as tidy on stderr, in the given order
+    return "".join(f"line {line} column {column} - {kind}: {message}\n"
+                   for (line, column), kind, message in messages)
+
+
+def validate_html(html):
+    """
+    Validates an HTML document without running tidy.
+
+    Parameters:
+    html (str): The HTML document in string format.
+
+    Returns:
+    str: The problems found, one "line L column C - Kind: message" line each, as tidy prints them.
+    """
+    validator = HtmlValidator()
+    validator.feed(html)
+    validator.close()
+    # The checks run at different times, so their messages are put back in document order
+    return format_messages(sorted(validator.messages, key=lambda item: item[0]))
+
+
+def tidy_file(file_path):
+    """
+    Runs tidy on one file as postprocessing always did, the reference of validate_html and of tidy_batch.
+
+    Returns:
+    str: The stderr of tidy, read by cleanup_errors_from_tidy.
+    """
+    result = subprocess.run(["tidy"] + TIDY_OPTIONS + [file_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return result.stderr.decode()
+
+
+def tidy_batch(file_paths):
+    """
+    Validates many files with a single tidy process.
+
+    Parameters:
+    file_paths (list): The HTML files.
+
+    Returns:
+    dict: The messages of every file, in the format of validate_html and in the order tidy prints them.
+    """
+    result = subprocess.run(["tidy", "-errors", "-quiet", "--gnu-emacs", "yes"] + TIDY_OPTIONS + list(file_paths),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    messages = {file_path: [] for file_path in file_paths}
+    for line in result.stderr.decode().splitlines():
+        match = TIDY_EMACS_LINE.match(line)
+        if match and match.group(1) in messages:
+            file_path, line_number, column, kind, message = match.groups()
+            messages[file_path].append(((int(line_number), int(column)), kind, message))
+    return {file_path: format_messages(file_messages) for file_path, file_messages in messages.items()}
@@ -0,0 +1,126 @@
+import contextlib
+import queue
+import signal
+from collections import Counter, deque, namedtuple
+
+# One metric of one sample, cost is a rough estimate in seconds used to order and group the tasks
+MetricTask = namedtuple("MetricTask", ["sample", "metric", "paths", "settings", "inputs_hash", "cost"])
+
+# Every worker gets about this many batches of each metric, so the last ones finish close together
+BATCHES_PER_WORKER = 8
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    """Raises TaskTimeout in the block after the given number of seconds, on platforms with SIGALRM."""
+    if not seconds or not hasattr(signal, "SIGALRM"):
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TaskTimeout()
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def run_batch(args):
+    """Runs a batch of tasks in a worker, each one with its own time limit."""
+    function, tasks, timeout = args
+    results = []
+    for task in tasks:
+        try:
+            with time_limit(timeout):
+                value, fields = function(task)
+            results.append((task, value, fields, False))
+        except TaskTimeout:
+            results.append((task, None, {f"{task.metric}_timeout": True}, True))
+    return results
+
+
+def make_batches(tasks, workers):
+    """
+    Groups the tasks of every metric in batches, largest tasks first.
+
+    Large tasks get a batch of their own, small ones are grouped until the batch reaches a
+    fraction of the total cost, so cheap metrics do not pay a round trip per task.
+
+    Returns:
+    dict: Batches of every metric, as deques of (cost, tasks) in decreasing cost order.
+    """
+    total_cost = sum(task.cost for task in tasks)
+    target_cost = total_cost / (workers * BATCHES_PER_WORKER) if tasks else 0
+
+    by_metric = dict()
+    for task in sorted(tasks, key=lambda task: task.cost, reverse=True):
+        by_metric.setdefault(task.metric, []).append(task)
+
+    batches = dict()
+    for metric, metric_tasks in by_metric.items():
+        metric_batches, batch, cost = [], [], 0
+        for task in metric_tasks:
+            batch.append(task)
+            cost += task.cost
+            if cost >= target_cost:
+                metric_batches.append((cost, batch))
+                batch, cost = [], 0
+        if batch:
+            metric_batches.append((cost, batch))
+        batches[metric] = deque(sorted(metric_batches, key=lambda item: item[0], reverse=True))
+    return batches
+
+
+def schedule(pool, function, tasks, workers, metric_workers=None, timeout=None):
+    """
+    Runs the tasks on the pool and yields their results as they arrive.
+
+    Whenever a worker is free it gets the largest pending batch among the metrics that are
+    below their worker cap, so the expensive tasks start first and cheap ones fill the tail.
+
+    Parameters:
+    pool (multiprocessing.Pool): The pool of workers.
+    function (function): Computes a task, returns its value and its json fields.
+    tasks (list): The MetricTask to run.
+    workers (int): Number of workers of the pool.
+    metric_workers (dict): Maximum number of workers running each metric at the same time.
+    timeout (float): Seconds after which a task is abandoned, None for no limit.
+
+    Yields:
+    tuple: The task, its value, its json fields and whether it timed out.
+    """
+    metric_workers = metric_workers or dict()
+    pending = make_batches(tasks, workers)
+    running = Counter()
+    results = queue.Queue()
+
+    def dispatch():
+        while sum(running.values()) < workers:
+            candidates = [metric for metric, batches in pending.items()
+                          if batches and running[metric] < metric_workers.get(metric, workers)]
+            if not candidates:
+                return
+            metric = max(candidates, key=lambda metric: pending[metric][0][0])
+            _, batch = pending[metric].popleft()
+            running[metric] += 1
+            pool.apply_async(run_batch, ((function, batch, timeout),),
+                             callback=lambda batch_results, metric=metric: results.put((metric, batch_results, None)),
+                             error_callback=lambda error, metric=metric: results.put((metric, None, error)))
+
+    dispatch()
+    while sum(running.values()) > 0:
+        metric, batch_results, error = results.get()
+        running[metric] -= 1
+        if error is not None:
+            raise error
+        dispatch()
+        for result in batch_results:
+            yield result
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+# Part of every inputs hash, bump it when a metric changes so the stored results are recomputed
+STORE_VERSION = 2
+
+# Metrics averaged over the samples
+METRICS = ["ted", "ssim_index", "ed", "bleu", "s_bleu", "html_bleu"]
+
+
+def file_hash(path):
+    """
+    Hashes the content of a file.
+
+    Returns:
+    str: The path.
+    str: The hex digest, "missing" when the file does not exist.
+    """
+    if not os.path.exists(path):
+        return path, "missing"
+    sha = hashlib.sha1()
+    with open(path, "rb") as reader:
+        for block in iter(lambda: reader.read(1 << 20), b""):
+            sha.update(block)
+    return path, sha.hexdigest()
+
+
+def inputs_hash(metric, file_hashes, settings):
+    """
+    Hashes the inputs of a metric of a sample, the content of its files and the options that change its value.
+
+    Parameters:
+    metric (str): The metric.
+    file_hashes (list): The hashes of its input files, in order.
+    settings (tuple): The options of the metric.
+
+    Returns:
+    str: The hex digest.
+    """
+    return hashlib.sha1(f"{STORE_VERSION} {metric} {settings!r} {' '.join(file_hashes)}".encode()).hexdigest()
+
+
+class MetricsStore():
+    """
+    SQLite file with every metric of every sample of a run, keyed by the sample, the metric and the hash of its inputs.
+    Results are committed every commit_every metrics, so an interrupted run resumes from the last commit.
+    """
+
+    def __init__(self, path, commit_every=200):
+        self.connection = sqlite3.connect(path)
+        self.commit_every = commit_every
+        self.pending = 0
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS metric_results (sample TEXT NOT NULL, metric TEXT NOT NULL, "
+                                "inputs_hash TEXT NOT NULL, value REAL, fields TEXT NOT NULL, PRIMARY KEY (sample, metric))")
+        self.connection.commit()
+
+    def hashes(self):
+        return {(sample, metric): inputs_hash for sample, metric, inputs_hash
+                in self.connection.execute("SELECT sample, metric, inputs_hash FROM metric_results")}
+
+    def get(self, sample, metric):
+        value, fields = self.connection.execute("SELECT value, fields FROM metric_results WHERE sample = ? AND metric = ?",
+                                                (sample, metric)).fetchone()
+        return value, json.loads(fields)
+
+    def put(self, sample, metric, inputs_hash, value, fields):
+        self.connection.execute("INSERT OR REPLACE INTO metric_results VALUES (?, ?, ?, ?, ?)",
+                                (sample, metric, inputs_hash, value, json.dumps(fields)))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def delete(self, sample, metric):
+        self.connection.execute("DELETE FROM metric_results WHERE sample = ? AND metric = ?", (sample, metric))
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class RunningMeans():
+    """Means of the metrics updated as the results arrive, None values are left out."""
+
+    def __init__(self, names=METRICS):
+        self.sums = dict.fromkeys(names, 0.0)
+        self.counts = dict.fromkeys(names, 0)
+
+    def add(self, name, value):
+        if value is not None:
+            self.sums[name] += value
+            self.counts[name] += 1
+
+    def mean(self, name):
+        return self.sums[name] / self.counts[name] if self.counts[name] else float("nan")
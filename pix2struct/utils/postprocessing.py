@@ -2,9 +2,11 @@ import subprocess
 import argparse
 import os
 import json
+import multiprocessing
 from tqdm import tqdm
 import re
 from bs4 import BeautifulSoup
+from html_validation import validate_html, tidy_batch, TIDY_BATCH_SIZE
 
 def clean_html_gaps(html_str):
     html_str = re.sub(r'hre\s+f=', 'href=', html_str)
@@ -46,20 +48,6 @@ def process_Pix2Code_gui_file(folder, input_file_name, output_file_name):
 
 
 
-def process_Pix2Code_html_file(folder, input_file_name, output_file_name):
-    with open(folder + input_file_name, "r") as f:
-        content = f.read()
-
-    #content_with_spaces_fixed = fix_html_spaces(content)
-    content_with_header = content.replace(
-        '<html>', '<html> <header> <meta charset="utf-8"> <meta name="viewport" content="width=device-width, initial-scale=1"> <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css" integrity="sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u" crossorigin="anonymous"> <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap-theme.min.css" integrity="sha384-rHyoN1iRsVXV4nD0JutlnGaslCJuC7uwjduW9SVrLvRYooPp2bWYgmgJQIXwl/Sp" crossorigin="anonymous"> <style> .header{margin:20px 0}nav ul.nav-pills li{background-color:#333;border-radius:4px;margin-right:10px}.col-lg-3{width:24%;margin-right:1.333333%}.col-lg-6{width:49%;margin-right:2%}.col-lg-12,.col-lg-3,.col-lg-6{margin-bottom:20px;border-radius:6px;background-color:#f5f5f5;padding:20px}.row .col-lg-3:last-child,.row .col-lg-6:last-child{margin-right:0}footer{padding:20px 0;text-align:center;border-top:1px solid #bbb} </style> <title>Scaffold</title> </header>')
-    content_with_footer_and_scripts = content_with_header.replace('</main>', '<footer class="footer"> <p>&copy; Tony Beltramelli 2017</p> </footer> </main> <script src="js/jquery.min.js"></script> <script src="js/bootstrap.min.js"></script>')
-
-    with open(folder + output_file_name, "w") as f:
-        f.write(content_with_footer_and_scripts)
-    return
-
-
 def separate_WebUI2Code_html_css_files(folder, txt_file, output_html_file_name, output_css_file_name):
     token_not_found = False
     title_not_found = False
@@ -93,87 +81,130 @@ def separate_WebUI2Code_html_css_files(folder, txt_file, output_html_file_name,
     return token_not_found, title_not_found
 
 
-def process_files(folder, suffix=".txt", isPix2Code=False, isWebUI2Code=False):
-    files_paths = [file for file in os.listdir(folder) if file.endswith(suffix)]
-    for file_path in tqdm(files_paths):
-        if file_path.endswith("_processed" + suffix) or file_path.endswith("_complete" + suffix) or file_path.endswith("_separated" + suffix):
-            # Already processed
-            continue
+def process_file(args):
+    """
+    Postprocesses one prediction or answer file, run in the workers of process_files.
 
+    Returns:
+    str: The json file of the sample, None when the file does not need one.
+    dict: Its fields, without the validation errors.
+    str: The file whose validation errors go in the json file, None when there are none.
+    str: The validation messages, None when they are left to the batched tidy step.
+    """
+    folder, file_path, suffix, isPix2Code, isWebUI2Code, validator = args
+    # Tidy runs afterwards on batches of files
+    validator = validator if validator == "python" else None
 
-        if isPix2Code:
-            if suffix == ".gui":
-                output_file_path = file_path.split(suffix)[0] + "_processed.gui"
-                process_Pix2Code_gui_file(folder, file_path, output_file_path)
-                extract_html_file_from_gui(folder, output_file_path)
-
-            else:
-                output_file_path = file_path.split(suffix)[0] + "_processed.html"
-                process_Pix2Code_html_file(
-                    folder, file_path, output_file_path)
-
-            if file_path.endswith("pred" + suffix):
-                dict_tmp = {}
-                with open(folder + file_path.split("_pred")[0] + ".json", "w") as f:
-                    json.dump(dict_tmp, f, indent=2)
-
-        elif isWebUI2Code:
-            output_html_file_name = file_path.split(
-                suffix)[0] + "_separated.html"
-            output_css_file_name = file_path.split(
-                suffix)[0] + "_separated.css"
-            token_not_found, title_not_found = separate_WebUI2Code_html_css_files(
-                folder, file_path, output_html_file_name, output_css_file_name)
-            output_file_path = output_html_file_name.split(".html")[0] + "_processed.html"
-            errors_from_tidy = process_html(
-                folder + output_html_file_name, folder + output_file_path)
-
-            if file_path.endswith("pred" + suffix):
-                dict_tmp = {}
-                with open(folder + file_path.split("_pred")[0] + ".json", "w") as f:
-                    dict_tmp["errors"] = cleanup_errors_from_tidy(errors_from_tidy)
-                    dict_tmp["token_not_found"] = token_not_found
-                    dict_tmp["title_not_found"] = title_not_found
-                    json.dump(dict_tmp, f, indent=2)
-            else:
-                dict_tmp = {}
-                with open(folder + file_path.split("_answer")[0] + "_answer.json", "w") as f:
-                    dict_tmp["errors"] = cleanup_errors_from_tidy(errors_from_tidy)
-                    dict_tmp["token_not_found"] = token_not_found
-                    dict_tmp["title_not_found"] = title_not_found
-                    json.dump(dict_tmp, f, indent=2)
-            
+    if isPix2Code:
+        if suffix == ".gui":
+            output_file_path = file_path.split(suffix)[0] + "_processed.gui"
+            process_Pix2Code_gui_file(folder, file_path, output_file_path)
+            extract_html_file_from_gui(folder, output_file_path)
 
         else:
             output_file_path = file_path.split(suffix)[0] + "_processed.html"
-            errors_from_tidy = process_html(
-                folder + file_path, folder + output_file_path)
-            if file_path.endswith("pred" + suffix):
-                dict_tmp = {}
-                with open(folder + file_path.split("_pred")[0] + ".json", "w") as f:
-                    dict_tmp["errors"] = cleanup_errors_from_tidy(errors_from_tidy)
-                    json.dump(dict_tmp, f, indent=2)
+            process_Pix2Code_html_file(
+                folder, file_path, output_file_path)
+
+        if file_path.endswith("pred" + suffix):
+            return folder + file_path.split("_pred")[0] + ".json", {}, None, None
+        return None, {}, None, None
+
+    if isWebUI2Code:
+        output_html_file_name = file_path.split(
+            suffix)[0] + "_separated.html"
+        output_css_file_name = file_path.split(
+            suffix)[0] + "_separated.css"
+        token_not_found, title_not_found = separate_WebUI2Code_html_css_files(
+            folder, file_path, output_html_file_name, output_css_file_name)
+        output_file_path = output_html_file_name.split(".html")[0] + "_processed.html"
+        errors = process_html(
+            folder + output_html_file_name, folder + output_file_path, validator)
+
+        fields = {"token_not_found": token_not_found, "title_not_found": title_not_found}
+        if file_path.endswith("pred" + suffix):
+            json_path = folder + file_path.split("_pred")[0] + ".json"
+        else:
+            json_path = folder + file_path.split("_answer")[0] + "_answer.json"
+        return json_path, fields, folder + output_file_path, errors
+
+    output_file_path = file_path.split(suffix)[0] + "_processed.html"
+    errors = process_html(
+        folder + file_path, folder + output_file_path, validator)
+    if file_path.endswith("pred" + suffix):
+        return folder + file_path.split("_pred")[0] + ".json", {}, folder + output_file_path, errors
+    return None, {}, None, None
+
+
+def process_files(folder, suffix=".txt", isPix2Code=False, isWebUI2Code=False, validator="tidy", workers=None):
+    """
+    Postprocesses every prediction and answer file of a folder in a pool of processes.
+
+    Parameters:
+    folder (str): The folder of the files, ending with "/".
+    suffix (str): Extension of the files to process.
+    isPix2Code, isWebUI2Code (bool): Experiment whose results are processed.
+    validator (str): "tidy" runs tidy on batches of files after the postprocessing, "python" validates the HTML
+                     in the workers with html_validation.validate_html, which only approximates the messages of tidy.
+    workers (int): Number of processes, defaults to the number of CPUs.
+    """
+    files_paths = [file for file in os.listdir(folder) if file.endswith(suffix) and not (
+        # Already processed
+        file.endswith("_processed" + suffix) or file.endswith("_complete" + suffix) or file.endswith("_separated" + suffix))]
+
+    tasks = [(folder, file_path, suffix, isPix2Code, isWebUI2Code, validator) for file_path in files_paths]
+    with multiprocessing.Pool(processes=workers) as pool:
+        results = list(tqdm(pool.imap_unordered(process_file, tasks, chunksize=8), total=len(tasks)))
+
+        if validator == "tidy":
+            validated_paths = [validated_path for _, _, validated_path, _ in results if validated_path]
+            batches = [validated_paths[i:i + TIDY_BATCH_SIZE] for i in range(0, len(validated_paths), TIDY_BATCH_SIZE)]
+            tidy_errors = dict()
+            for batch_errors in tqdm(pool.imap_unordered(tidy_batch, batches), total=len(batches)):
+                tidy_errors.update(batch_errors)
+            results = [(json_path, fields, validated_path, tidy_errors.get(validated_path, ""))
+                       for json_path, fields, validated_path, _ in results]
+
+    for json_path, fields, validated_path, errors in results:
+        if json_path is None:
+            continue
+        dict_tmp = {}
+        if validated_path is not None:
+            dict_tmp["errors"] = cleanup_errors_from_tidy(errors)
+        dict_tmp.update(fields)
+        with open(json_path, "w") as f:
+            json.dump(dict_tmp, f, indent=2)
+
+
+def prettify_html(raw_html):
+    cleaned = clean_html_gaps(raw_html)
+    soup = BeautifulSoup(cleaned, "html.parser")
+    return soup.prettify()
 
 
+def process_html(input_file_path, output_file_path, validator="tidy"):
+    """
+    Fixes the gaps and prettifies an HTML file, then validates the result.
 
-def process_html(input_file_path, output_file_path):
+    Parameters:
+    validator (str): "tidy", "python" for html_validation.validate_html, or None when the file is validated later.
+
+    Returns:
+    str: The validation messages in the format of tidy, None without validator.
+    """
     with open(input_file_path, "r") as f:
         raw_html = f.read()
 
-    cleaned = clean_html_gaps(raw_html)
-    soup = BeautifulSoup(cleaned, "html.parser")
-    prettified = soup.prettify()
+    prettified = prettify_html(raw_html)
 
     with open(output_file_path, "w") as f:
         f.write(prettified)
 
-    # Optionally still run tidy for validation
-    command = f"tidy -indent -wrap 0 --drop-empty-elements no {output_file_path}"
-    result = subprocess.run(
-        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    errors = result.stderr.decode()
-
-    return errors
+    if validator == "python":
+        return validate_html(prettified)
+    if validator == "tidy":
+        return tidy_batch([output_file_path])[output_file_path]
+    return None
 
 
 
@@ -205,11 +236,16 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="post-processing of predictions and answers with correction of syntax errors",
                                      usage="python3 postprocessing.py --folder {folder}")
     parser.add_argument("--folder", help="Folder with files to process")
-    parser.add_argument("--suffix", help="Suffix of files to process")
+    parser.add_argument("--suffix", default=".txt", help="Suffix of files to process")
     parser.add_argument("--pix2code", action='store_true',
                         help="Specifies if we are preprocessing the results of Pix2Code experiment, which need particular postprocessing")
     parser.add_argument("--webui2code", action='store_true',
                         help="Specifies if we are preprocessing the results of WebUI2Code experiment, which need particular postprocessing")
+    parser.add_argument("--validator", choices=["python", "tidy"], default="tidy",
+                        help="Validate the HTML with tidy run on batches of files after the postprocessing, or in-process "
+                             "with a checker that only approximates the messages of tidy")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of worker processes")
 
     # Read args
     args = parser.parse_args()
@@ -219,7 +255,5 @@ if __name__ == "__main__":
         if not folder.endswith("/"):
             folder = folder + "/"
 
-    if args.suffix:
-        suffix = args.suffix
-
-    process_files(folder,  suffix=suffix, isPix2Code=args.pix2code, isWebUI2Code=args.webui2code)
+    process_files(folder, suffix=args.suffix, isPix2Code=args.pix2code, isWebUI2Code=args.webui2code,
+                  validator=args.validator, workers=args.workers)
@@ -0,0 +1,33 @@
+import argparse
+import shutil
+import tempfile
+from pathlib import Path
+from postprocessing import prettify_html
+from html_validation import tidy_file
+
+FIXTURES_DIR = Path(__file__).resolve().parent / "tidy_fixtures"
+
+
+def record(fixtures_dir=FIXTURES_DIR):
+    """
+    Writes next to every HTML fixture the stderr of tidy on its prettified version, as NAME.tidy.
+    test_html_validation compares validate_html with these files.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        for fixture in sorted(Path(fixtures_dir).glob("*.html")):
+            # Same input as tidy gets in postprocessing
+            prettified_path = Path(tmp, fixture.name)
+            prettified_path.write_text(prettify_html(fixture.read_text()))
+            fixture.with_suffix(".tidy").write_text(tidy_file(str(prettified_path)))
+            print(f"Recorded {fixture.with_suffix('.tidy').name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record the tidy output of the validator fixtures",
+                                     usage="python3 record_tidy_fixtures.py [--fixtures_dir {dir}]")
+    parser.add_argument("--fixtures_dir", default=str(FIXTURES_DIR), help="Folder of the HTML fixtures")
+    args = parser.parse_args()
+
+    if shutil.which("tidy") is None:
+        raise SystemExit("tidy is not installed")
+    record(args.fixtures_dir)
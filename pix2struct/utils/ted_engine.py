@@ -0,0 +1,310 @@
+import time
+import numpy as np
+
+# Upper bound of the forest distance cells kept in memory for one keyroot of the first tree
+MAX_FOREST_CELLS = 1 << 23
+
+
+class PostorderTree():
+    """
+    Array encoding of a tree for the Zhang-Shasha algorithm.
+
+    Attributes:
+    labels (np.ndarray): Integer label id of every node, in postorder.
+    leftmost (np.ndarray): Postorder index of the leftmost leaf descendant of every node.
+    parents (np.ndarray): Postorder index of the parent of every node, -1 for the root.
+    keyroots (list): Postorder indices of the keyroots, the root and every node with a left sibling.
+    keyroot_levels (list): Nesting level of every keyroot, 0 when its subtree holds no other keyroot.
+    """
+
+    def __init__(self, labels, leftmost, parents, keyroots, keyroot_levels):
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.leftmost = np.asarray(leftmost, dtype=np.int64)
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.keyroots = keyroots
+        self.keyroot_levels = keyroot_levels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def subtree_sizes(self):
+        return np.arange(len(self)) - self.leftmost + 1
+
+    def children(self):
+        """Lists the children of every node, in order."""
+        children = [[] for _ in range(len(self))]
+        for node, parent in enumerate(self.parents.tolist()):
+            if parent >= 0:
+                children[parent].append(node)
+        return children
+
+
+def encode_tree(root, get_children, get_label, label_ids):
+    """
+    Encodes a tree in postorder, without recursion so deep documents do not hit the recursion limit.
+
+    Parameters:
+    root: The root node of the tree.
+    get_children (function): Returns the list of children of a node.
+    get_label (function): Returns the label of a node.
+    label_ids (dict): Interns the labels to integers, share it between the trees that are compared.
+
+    Returns:
+    PostorderTree: The encoded tree.
+    """
+    labels, leftmost, parents = [], [], []
+    keyroots, keyroot_levels = [], []
+    # Highest keyroot level found in the subtree of every encoded node
+    subtree_levels = []
+
+    # Frames hold the node, its children, the next child to visit, the leftmost leaf and the child positions
+    stack = [[root, get_children(root), 0, None, []]]
+    while stack:
+        frame = stack[-1]
+        node, children, index = frame[0], frame[1], frame[2]
+        if index < len(children):
+            frame[2] += 1
+            stack.append([children[index], get_children(children[index]), 0, None, []])
+            continue
+
+        stack.pop()
+        position = len(labels)
+        labels.append(label_ids.setdefault(get_label(node), len(label_ids)))
+        leftmost.append(frame[3] if frame[3] is not None else position)
+        parents.append(-1)
+        for child in frame[4]:
+            parents[child] = position
+
+        inner_level = max((subtree_levels[child] for child in frame[4]), default=-1)
+        # The root and the nodes with a left sibling are the keyroots
+        if not stack or stack[-1][2] > 1:
+            keyroots.append(position)
+            keyroot_levels.append(inner_level + 1)
+            subtree_levels.append(inner_level + 1)
+        else:
+            subtree_levels.append(inner_level)
+
+        if stack:
+            parent = stack[-1]
+            if parent[3] is None:
+                parent[3] = leftmost[-1]
+            parent[4].append(position)
+
+    return PostorderTree(labels, leftmost, parents, keyroots, keyroot_levels)
+
+
+class _ColumnChunk():
+    """
+    Forest distance columns of several keyroots of the second tree, side by side.
+
+    Every keyroot gets a segment made of an empty forest column followed by one column per node
+    of its subtree, so the rows of all their forest distance tables are computed at once.
+    """
+
+    def __init__(self, tree, keyroots, big):
+        nodes, left_columns, on_path, positions, segment_ids = [], [], [], [], []
+        start = 0
+        for segment, keyroot in enumerate(keyroots):
+            first = tree.leftmost[keyroot]
+            size = keyroot - first + 1
+            subtree = np.arange(first, keyroot + 1)
+
+            nodes.append(np.concatenate(([0], subtree)))
+            left_columns.append(np.concatenate(([start], start + tree.leftmost[subtree] - first)))
+            on_path.append(np.concatenate(([False], tree.leftmost[subtree] == first)))
+            positions.append(np.arange(size + 1))
+            segment_ids.append(np.full(size + 1, segment))
+            start += size + 1
+
+        self.nodes = np.concatenate(nodes)
+        self.left_columns = np.concatenate(left_columns)
+        self.on_path = np.concatenate(on_path)
+        positions = np.concatenate(positions)
+        self.empty = positions == 0
+        self.previous_columns = np.maximum(np.arange(len(self.nodes)) - 1, 0)
+        self.labels = tree.labels[self.nodes]
+        self.first_row = positions
+        # Later segments get a lower offset, so a cumulative minimum never crosses a segment start
+        self.shift = positions + np.concatenate(segment_ids) * big
+        self.path_columns = np.flatnonzero(self.on_path)
+        self.path_nodes = self.nodes[self.path_columns]
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def _column_chunks(tree, max_columns, big):
+    """Groups the keyroots of a tree by level, and every level in chunks of at most max_columns columns."""
+    levels = dict()
+    for keyroot, level in zip(tree.keyroots, tree.keyroot_levels):
+        levels.setdefault(level, []).append(keyroot)
+
+    chunks = []
+    for level in sorted(levels):
+        chunk, columns = [], 0
+        for keyroot in levels[level]:
+            size = keyroot - tree.leftmost[keyroot] + 2
+            if chunk and columns + size > max_columns:
+                chunks.append(_ColumnChunk(tree, chunk, big))
+                chunk, columns = [], 0
+            chunk.append(keyroot)
+            columns += size
+        chunks.append(_ColumnChunk(tree, chunk, big))
+    return chunks
+
+
+def tree_edit_distance(tree1, tree2, deadline=None):
+    """
+    Zhang-Shasha tree edit distance where insert, remove and update all cost 1.
+
+    The keyroots of the first tree are visited one by one as usual, but for each of them the
+    forest distance tables of all the keyroots of the second tree on the same level are filled
+    together, one vectorized row at a time. A keyroot only depends on the keyroots nested in its
+    subtree, which are on lower levels. The minimum over insertions along a row is a cumulative
+    minimum, so no cell is computed in Python.
+
+    Parameters:
+    tree1, tree2 (PostorderTree): The trees to be compared, encoded with the same label ids.
+    deadline (float): time.monotonic() value after which the computation is abandoned.
+
+    Returns:
+    int: The tree edit distance, None when the deadline passed first.
+    """
+    n1, n2 = len(tree1), len(tree2)
+    treedist = np.zeros((n1, n2), dtype=np.int32)
+    max_columns = max(MAX_FOREST_CELLS // (n1 + 1), 1)
+    big = n1 + 2 * n2 + 2
+    chunks = _column_chunks(tree2, max_columns, big)
+
+    for keyroot in tree1.keyroots:
+        first = tree1.leftmost[keyroot]
+        rows = keyroot - first + 1
+
+        for chunk in chunks:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+
+            forestdist = np.empty((rows + 1, len(chunk)), dtype=np.int64)
+            forestdist[0] = chunk.first_row
+
+            for row in range(1, rows + 1):
+                node = first + row - 1
+                node_first = tree1.leftmost[node]
+                previous = forestdist[row - 1]
+
+                # Matching the subtrees of the two nodes, after the forests left of them
+                candidates = forestdist[node_first - first, chunk.left_columns] + treedist[node, chunk.nodes]
+                if node_first == first:
+                    # Both nodes on the leftmost paths, the subtree distance is being computed here
+                    update = previous[chunk.previous_columns] + (chunk.labels != tree1.labels[node])
+                    candidates = np.where(chunk.on_path, update, candidates)
+
+                # Removing the node
+                best = np.minimum(previous + 1, candidates)
+                best[chunk.empty] = row
+
+                # Inserting nodes, forestdist[row, j] = min over k <= j of best[k] + j - k within the segment
+                forestdist[row] = np.minimum.accumulate(best - chunk.shift) + chunk.shift
+
+                if node_first == first:
+                    treedist[node, chunk.path_nodes] = forestdist[row, chunk.path_columns]
+
+    return int(treedist[n1 - 1, n2 - 1])
+
+
+def lower_bound(tree1, tree2):
+    """
+    Lower bound of the unit cost tree edit distance, from label and degree histograms.
+
+    Matching m nodes costs at least n1 + n2 - 2m edits, plus a rename for every matched pair
+    beyond the common labels, so the distance is at least max(n1, n2) minus the size of the label
+    histogram intersection. An insertion or deletion changes at most 3 bins of the degree
+    histogram (the node and its parent) and a rename none, so the L1 distance of the degree
+    histograms divided by 3 is a lower bound as well.
+
+    Parameters:
+    tree1, tree2 (PostorderTree): The trees to be compared, encoded with the same label ids.
+
+    Returns:
+    int: The lower bound.
+    """
+    n1, n2 = len(tree1), len(tree2)
+    labels = max(tree1.labels.max(), tree2.labels.max()) + 1
+    common = np.minimum(np.bincount(tree1.labels, minlength=labels), np.bincount(tree2.labels, minlength=labels)).sum()
+
+    degrees1 = np.bincount(np.bincount(tree1.parents[tree1.parents >= 0], minlength=n1))
+    degrees2 = np.bincount(np.bincount(tree2.parents[tree2.parents >= 0], minlength=n2))
+    size = max(len(degrees1), len(degrees2))
+    degree_distance = np.abs(np.pad(degrees1, (0, size - len(degrees1))) - np.pad(degrees2, (0, size - len(degrees2)))).sum()
+
+    return int(max(max(n1, n2) - common, -(-degree_distance // 3)))
+
+
+def _align_children(children1, children2, labels1, labels2, sizes1, sizes2):
+    """
+    Aligns two lists of sibling subtrees, removing and inserting whole subtrees costs their size.
+
+    The cost of pairing two subtrees is estimated by their root rename and their size difference.
+
+    Returns:
+    list: The paired subtrees.
+    int: The cost of the removed and inserted subtrees.
+    """
+    children1, children2 = np.asarray(children1), np.asarray(children2)
+    remove, insert = sizes1[children1], sizes2[children2]
+    pair = (labels1[children1][:, None] != labels2[children2][None, :]) + np.abs(remove[:, None] - insert[None, :])
+
+    # Row by row, the insertions along a row are a cumulative minimum over the prefix sums of their costs
+    inserted = np.concatenate(([0], np.cumsum(insert)))
+    table = np.empty((len(children1) + 1, len(children2) + 1), dtype=np.int64)
+    table[0] = inserted
+    for row in range(1, len(children1) + 1):
+        best = table[row - 1] + remove[row - 1]
+        best[1:] = np.minimum(best[1:], table[row - 1, :-1] + pair[row - 1])
+        table[row] = np.minimum.accumulate(best - inserted) + inserted
+
+    pairs, cost = [], 0
+    row, column = len(children1), len(children2)
+    while row > 0 or column > 0:
+        if row > 0 and column > 0 and table[row, column] == table[row - 1, column - 1] + pair[row - 1, column - 1]:
+            pairs.append((children1[row - 1], children2[column - 1]))
+            row, column = row - 1, column - 1
+        elif row > 0 and table[row, column] == table[row - 1, column] + remove[row - 1]:
+            cost += remove[row - 1]
+            row -= 1
+        else:
+            cost += insert[column - 1]
+            column -= 1
+    return pairs, int(cost)
+
+
+def upper_bound(tree1, tree2):
+    """
+    Upper bound of the unit cost tree edit distance, the cost of a top-down mapping.
+
+    The roots are mapped to each other and the children of every mapped pair are aligned level
+    by level, unaligned subtrees are removed or inserted. This is a valid edit script, so its
+    cost bounds the distance, and it only compares siblings of mapped nodes.
+
+    Parameters:
+    tree1, tree2 (PostorderTree): The trees to be compared, encoded with the same label ids.
+
+    Returns:
+    int: The upper bound.
+    """
+    children1, children2 = tree1.children(), tree2.children()
+    sizes1, sizes2 = tree1.subtree_sizes(), tree2.subtree_sizes()
+
+    cost = 0
+    pairs = [(len(tree1) - 1, len(tree2) - 1)]
+    while pairs:
+        node1, node2 = pairs.pop()
+        cost += int(tree1.labels[node1] != tree2.labels[node2])
+        if not children1[node1] or not children2[node2]:
+            cost += int(sizes1[children1[node1]].sum() + sizes2[children2[node2]].sum())
+            continue
+        aligned, unaligned_cost = _align_children(children1[node1], children2[node2],
+                                                  tree1.labels, tree2.labels, sizes1, sizes2)
+        cost += unaligned_cost
+        pairs.extend(aligned)
+    return cost
@@ -0,0 +1,18 @@
+import pytest
+
+from html_document import HtmlDocument, lxml
+
+PARSERS = ["html.parser"] + (["lxml"] if lxml is not None else [])
+
+
+@pytest.mark.parametrize("parser", PARSERS)
+def test_xml_encoding_declaration(parser):
+    document = HtmlDocument('<?xml version="1.0" encoding="UTF-8"?><html><body><p>x</p></body></html>', parser)
+    # [document], html, body, p
+    assert document.node_count == 4
+    assert "<p> </p>" in document.text_stripped
+
+
+@pytest.mark.parametrize("parser", PARSERS)
+def test_empty_document(parser):
+    assert HtmlDocument("", parser).node_count == 1
@@ -0,0 +1,75 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from html_validation import validate_html, tidy_file
+from postprocessing import cleanup_errors_from_tidy, prettify_html
+
+FIXTURES_DIR = Path(__file__).resolve().parent / "tidy_fixtures"
+FIXTURES = sorted(FIXTURES_DIR.glob("*.html"))
+GOLDENS = [fixture for fixture in FIXTURES if fixture.with_suffix(".tidy").exists()]
+
+HEAD = "<!DOCTYPE html><html><head><title>t</title></head><body>"
+TAIL = "</body></html>"
+
+
+def messages(body):
+    return [error["error_message"] for error in cleanup_errors_from_tidy(validate_html(HEAD + body + TAIL))]
+
+
+def test_valid_document():
+    assert messages("<div><p>x</p></div>") == []
+
+
+@pytest.mark.parametrize("body", ["<p>a<p>b", "<ul><li>a<li>b</ul>", "<table><tr><td>a<td>b</table>",
+                                  "<div><p>a</div>"])
+def test_optional_end_tags(body):
+    assert messages(body) == []
+
+
+def test_block_in_paragraph():
+    assert messages("<p><div>x</div></p>") == ["missing </p> before <div>", "discarding unexpected </p>"]
+
+
+def test_list_item_in_list_item():
+    assert messages("<ul><li><li>x</li></li></ul>") == ["discarding unexpected </li>"]
+
+
+def test_nested_list_is_allowed():
+    assert messages("<ul><li><ul><li>x</li></ul></li></ul>") == []
+
+
+def test_attribute_without_value():
+    assert messages("<a href>x</a>") == ['<a> attribute "href" lacks value']
+
+
+def test_missing_end_tags():
+    assert messages("<div><span>x</div>") == ["missing </span> before </div>"]
+    assert messages("</span>") == ["discarding unexpected </span>"]
+
+
+def test_document_level_messages():
+    errors = cleanup_errors_from_tidy(validate_html("<html><body><foo></foo><img src='x'></body></html>"))
+    assert errors == [
+        {"position": "line 1 column 1", "error_type": "Warning", "error_message": "missing <!DOCTYPE> declaration"},
+        {"position": "line 1 column 1", "error_type": "Warning", "error_message": "inserting missing 'title' element"},
+        {"position": "line 1 column 13", "error_type": "Error", "error_message": "<foo> is not recognized!"},
+        {"position": "line 1 column 24", "error_type": "Warning", "error_message": '<img> lacks "alt" attribute'},
+    ]
+
+
+@pytest.mark.skipif(not GOLDENS, reason="No tidy output recorded, run record_tidy_fixtures.py where tidy is installed")
+@pytest.mark.parametrize("fixture", GOLDENS, ids=lambda fixture: fixture.stem)
+def test_matches_recorded_tidy(fixture):
+    expected = cleanup_errors_from_tidy(fixture.with_suffix(".tidy").read_text())
+    assert cleanup_errors_from_tidy(validate_html(prettify_html(fixture.read_text()))) == expected
+
+
+@pytest.mark.skipif(shutil.which("tidy") is None, reason="tidy is not installed")
+@pytest.mark.parametrize("fixture", FIXTURES, ids=lambda fixture: fixture.stem)
+def test_matches_tidy(fixture, tmp_path):
+    prettified = prettify_html(fixture.read_text())
+    prettified_path = tmp_path / fixture.name
+    prettified_path.write_text(prettified)
+    assert cleanup_errors_from_tidy(validate_html(prettified)) == cleanup_errors_from_tidy(tidy_file(str(prettified_path)))
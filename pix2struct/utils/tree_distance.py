@@ -1,6 +1,10 @@
 from zss import simple_distance, Node, distance
 from bs4 import BeautifulSoup
+from ted_engine import tree_edit_distance, lower_bound, upper_bound
+from html_document import HtmlDocument
+import numpy as np
 import re
+import time
 
 def count_nodes(node):
     """
@@ -53,18 +57,70 @@ def create_tree_recursive(bs4node, zssnode):
             zssnode.addkid(newnode)
             create_tree_recursive(child, newnode)
 
-def calculate_ted(html1, html2):
+def calculate_document_ted(document1, document2):
+    """
+    Calculates the Tree Edit Distance (TED) between two parsed HTML documents, with the numpy engine.
+
+    Parameters:
+    document1, document2 (HtmlDocument): The documents to be compared.
+
+    Returns:
+    float: The Tree Edit Distance between the two HTML documents.
+    float: The Normalized Tree Edit Distance between the two HTML documents, divided by the bigger number of nodes.
+    """
+    d = np.float64(tree_edit_distance(document1.tree, document2.tree))
+    return d, d / (max(document1.node_count, document2.node_count))
+
+def calculate_bounded_ted(document1, document2, max_nodes=None, time_budget=None):
+    """
+    Calculates the Tree Edit Distance (TED) between two parsed HTML documents within a node or time budget.
+    Cheap lower and upper bounds are computed first, the exact distance is only computed when they differ,
+    the bigger document has at most max_nodes nodes and it finishes within time_budget seconds.
+    Otherwise the upper bound, the cost of a top-down mapping of the documents, is returned as an approximation.
+
+    Parameters:
+    document1, document2 (HtmlDocument): The documents to be compared.
+    max_nodes (int): Maximum number of nodes of the bigger document for the exact computation, None for no limit.
+    time_budget (float): Maximum number of seconds spent on a pair of documents, None for no limit.
+
+    Returns:
+    float: The Tree Edit Distance between the two HTML documents, or its upper bound.
+    float: The Normalized Tree Edit Distance between the two HTML documents, divided by the bigger number of nodes.
+    bool: Whether the distance is approximate.
+    tuple: The lower and upper bounds of the distance.
+    """
+    start = time.monotonic()
+    tree1, tree2 = document1.tree, document2.tree
+    nodes = max(len(tree1), len(tree2))
+    bounds = (lower_bound(tree1, tree2), upper_bound(tree1, tree2))
+
+    d = None
+    if bounds[0] == bounds[1]:
+        d = bounds[0]
+    elif max_nodes is None or nodes <= max_nodes:
+        d = tree_edit_distance(tree1, tree2, deadline=start + time_budget if time_budget is not None else None)
+
+    approximate = d is None
+    d = np.float64(bounds[1] if approximate else d)
+    return d, d / nodes, approximate, bounds
+
+def calculate_ted(html1, html2, engine="numpy"):
     """
     Calculates the Tree Edit Distance (TED) between two HTML documents.
     All operations cost 1 (insert, remove, update)
 
     Parameters:
     html1, html2 (str): The HTML documents to be compared.
+    engine (str): "numpy" for the vectorized Zhang-Shasha of ted_engine, "zss" for the reference zss implementation.
+                  Both give the same distance.
 
     Returns:
     float: The Tree Edit Distance between the two HTML documents. 
     float: The Normalized Tree Edit Distance between the two HTML documents, divided by the bigger number of nodes. 
     """
+    if engine == "numpy":
+        return calculate_document_ted(HtmlDocument(html1, 'html.parser'), HtmlDocument(html2, 'html.parser'))
+
     tree1, nodes1 = create_tree(html1)
     tree2, nodes2 = create_tree(html2)
     #return simple_distance(tree1, tree2)